@@ -18,14 +18,30 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
-"""Configuration info."""
+"""
+Configuration info.
+
+``Config`` is the configuration of the current site, for reading and
+changing it. Code which only reads it should use ``snapshot()`` instead:
+an immutable ``ConfigSnapshot`` shared within the process, which is
+replaced whenever the configuration is changed by this process, when
+config.xml is found to have changed [checked at most once every
+CHECK_INTERVAL seconds], or after ``reload_config()`` [which tools/server
+calls on SIGHUP]. Each new snapshot applies its ``log`` level to the
+"Hojarama" logger and its handlers.
+
+"""
 
 import logging
 import os
+import time
 
 from lxml import etree
 
-from hojarama import HojaramaError, Persistent, ROOT, update_htaccess
+from hojarama import HojaramaError, Persistent, site, SitePath, update_htaccess
+
+from hrsqlite import switch_backend
+from hrxml import parse
 
 FUNCS = {basestring: {"in":  lambda x: x.lower(),
                       "out": lambda x: x},
@@ -42,7 +58,13 @@ FUNCS = {basestring: {"in":  lambda x: x.lower(),
 LOG_LEVELS = dict((k.lower(), v) for (k, v) in logging._levelNames.items()
                   if isinstance(k, basestring))
 
-PREFS = {"debug_hrx":  {"default": False},
+PREFS = {"backend":    {"cleanup": (switch_backend, [], {}),
+                        "convert": {"sqlite": "sqlite", "xml": "xml"},
+                        "default": "xml"},
+
+         "cache_limit": {"default": 0},
+
+         "debug_hrx":  {"default": False},
 
          "domain":     {"cleanup": (update_htaccess, [], {}),
                         "default": "localhost"},
@@ -59,7 +81,25 @@ PREFS = {"debug_hrx":  {"default": False},
 
          "nav_class":  {"cleanup": (Persistent.reset_cache,
                                     [("pages", "templates")], {}),
-                        "default": "global_nav"}}
+                        "default": "global_nav"},
+
+         "packed":     {"cleanup": (Persistent.reset_cache, ["pages"], {}),
+                        "default": False},
+
+         "profile":    {"default": 0},
+
+         "redirect":   {"cleanup": (Persistent.reset_cache, ["pages"], {}),
+                        "default": 0},
+
+         "shards":     {"cleanup": (Persistent.reset_cache, ["indices"], {}),
+                        "default": False},
+
+         "trace":      {"default": False}}
+
+CHECK_INTERVAL = 1.0
+
+_RELOAD = {"count": 0}
+_SNAPSHOTS = {}
 
 
 def _cleanup(opt):
@@ -95,20 +135,69 @@ def _convert(opt, arg, direction="in"):
     return func(arg)
 
 
+def _set_log_level(level):
+    """Set the level of the "Hojarama" logger and its handlers to `level`."""
+    logger = logging.getLogger("Hojarama")
+    logger.setLevel(level)
+    for handler in logger.handlers:
+        handler.setLevel(level)
+
+
+def _version():
+    """Return the modification time of config.xml, or None."""
+    try:
+        return os.stat(Config.path).st_mtime
+    except OSError:
+        return None
+
+
+def reload_config():
+    """Make each site reread its configuration and cache when next used."""
+    _RELOAD["count"] += 1
+
+
+def snapshot():
+    """Return the config snapshot of the current site."""
+    current_site = site()
+    entry = _SNAPSHOTS.get(current_site.root)
+    now = time.time()
+    if entry is not None:
+        config, checked, count = entry
+        if count != _RELOAD["count"]:
+            current_site.memo = {}
+        elif now < checked + CHECK_INTERVAL:
+            return config
+        elif _version() == config.version:
+            _SNAPSHOTS[current_site.root] = (config, now, count)
+            return config
+    version = _version()
+    config = ConfigSnapshot(Config(), version)
+    _SNAPSHOTS[current_site.root] = (config, now, _RELOAD["count"])
+    _set_log_level(config.log)
+    return config
+
+
 class Config(Persistent):
 
     """Configuration info."""
 
-    path = os.path.join(ROOT, "site", "config.xml")
+    path = SitePath("site", "config.xml")
 
     def __init__(self):
         # Does nothing useful, but really helps the pylint score ;-)
+        self.backend = None
+        self.cache_limit = None
         self.debug_hrx = None
         self.domain = None
         self.keep_empty = None
         self.log = None
         self.name = None
         self.nav_class = None
+        self.packed = None
+        self.profile = None
+        self.redirect = None
+        self.shards = None
+        self.trace = None
         Persistent.__init__(self)
 
     def _build(self):
@@ -120,7 +209,7 @@ class Config(Persistent):
 
     def _read(self):
         """Read the configuration from an XML file."""
-        doc = etree.ElementTree(file=self.path)
+        doc = parse(self.path, "cache")
         found = dict((e.get("id"), e.get("value")) for e in doc.getroot())
         for opt in PREFS:
             if opt in found:
@@ -159,6 +248,11 @@ class Config(Persistent):
         """Reset the option named `opt` to the default."""
         self.apply(opt)
 
+    def write(self, *changes):
+        """Write the configuration, and discard the current snapshot."""
+        Persistent.write(self, *changes)
+        _SNAPSHOTS.pop(site().root, None)
+
     def xml(self):
         """Return an XML representation of the configuration."""
         config_root = etree.Element("config")
@@ -168,3 +262,21 @@ class Config(Persistent):
             config_root.append(option_elem)
         return etree.ElementTree(config_root)
 
+
+class ConfigSnapshot(object):
+
+    """An immutable copy of the configuration of a site [see above]."""
+
+    __slots__ = tuple(sorted(PREFS)) + ("version",)
+
+    def __init__(self, config, version):
+        for opt in PREFS:
+            object.__setattr__(self, opt, getattr(config, opt))
+        object.__setattr__(self, "version", version)
+
+    def __repr__(self):
+        return "<ConfigSnapshot %r>" % self.version
+
+    def __setattr__(self, name, value):
+        raise AttributeError("cannot set %s: config snapshots are read-only"
+                             % name)
@@ -22,9 +22,11 @@
 
 import os
 
-from lxml import etree
+from hojarama import HojaramaError, Node, pop, SitePath
 
-from hojarama import HojaramaError, Node, pop, ROOT
+from hrxml import parse
+
+from Redirects import Redirects
 
 ERROR_DIR = "error"
 
@@ -33,6 +35,9 @@ HTTP_ERROR = {"401": "401 Unauthorised",
               "404": "404 Not found",
               "500": "500 Internal server error"}
 
+HTTP_REDIRECT = {301: "301 Moved Permanently",
+                 302: "302 Found"}
+
 NOT_FOUND = Node(ERROR_DIR + "/404")
 
 UNAVAILABLE = Node(ERROR_DIR + "/unavailable")
@@ -42,15 +47,24 @@ class Content(object):
 
     """Page content."""
 
-    root = os.path.join(ROOT, "site", "pages")
+    root = SitePath("site", "pages")
 
     def __init__(self, node, lang_id):
         self.cache = True
         self.lang_id = lang_id
         self.node = node
         self.history = []
+        self.redirect = None
         self.xml = None
-        self.__build()
+        try:
+            record = Redirects()[lang_id][node]
+        except KeyError:
+            self.__build()
+        else:
+            self.cache = record.cache
+            self.history = record.chain[:-1]
+            self.node = self.redirect = record.target()
+            self.__build()
 
     def __repr__(self):
         return "<Content '%s/%s'>" % (self.node, self.lang_id)
@@ -82,7 +96,7 @@ class Content(object):
             self.cache = False
             self.__build(NOT_FOUND)
         else:
-            self.xml = etree.ElementTree(file=path)
+            self.xml = parse(path, "content")
             hidden = pop(self.xml.getroot(), "hidden", False)
             redirect = pop(self.xml.getroot(), "redirect")
             self.cache = self.cache and pop(self.xml.getroot(), "cache", True)
@@ -90,7 +104,8 @@ class Content(object):
                 self.cache = False
                 self.__build(UNAVAILABLE)
             elif redirect is not None:
-                self.__build(Node(redirect))
+                self.redirect = Node(redirect)
+                self.__build(self.redirect)
 
     def status(self):
         """Return a HTTP status message."""
@@ -24,7 +24,9 @@ import os
 
 from lxml import etree
 
-from hojarama import Persistent, pop, ROOT
+from hojarama import Persistent, pop, site, SitePath
+
+from hrxml import parse
 
 from Languages import Languages
 
@@ -33,7 +35,7 @@ class Hidden(Persistent, dict):
 
     """Catalogue of hidden pages."""
 
-    path = os.path.join(ROOT, "cache", "hidden.xml")
+    path = SitePath("cache", "hidden.xml")
 
     def __init__(self):
         dict.__init__(self)
@@ -44,20 +46,34 @@ class Hidden(Persistent, dict):
     def _build(self):
         """Build the catalogue from scratch."""
         languages = Languages()
-        top = os.path.join(ROOT, "site", "pages")
+        top = os.path.join(site().root, "site", "pages")
         for path, _, files in os.walk(top):
             for lang_id in languages.visible:
                 filename = "%s.xml" % lang_id
                 if filename in files:
-                    doc = etree.ElementTree(file=os.path.join(path, filename))
+                    doc = parse(os.path.join(path, filename), "meta")
                     if pop(doc.getroot(), "hidden", False):
                         self[lang_id].append(path[len(top)+1:])
 
+    def _load(self, db):
+        """Read the catalogue from a database."""
+        for lang_id, node in db.execute("SELECT lang_id, node FROM hidden "
+                                        "ORDER BY rowid"):
+            if lang_id in self:
+                self[lang_id].append(node)
+
     def _read(self):
         """Read the catalogue from an XML file."""
-        for page_elem in etree.ElementTree(file=self.path).getroot():
+        for page_elem in parse(self.path, "cache").getroot():
             self[page_elem.get("lang")].append(page_elem.get("node"))
 
+    def _save(self, db):
+        """Write the catalogue to a database."""
+        db.execute("DELETE FROM hidden")
+        db.executemany("INSERT INTO hidden VALUES (?, ?)",
+                       [(lang_id, node) for lang_id in self
+                        for node in self[lang_id]])
+
     def xml(self):
         """Return an XML representation of the catalogue."""
         hidden_root = etree.Element("hidden")
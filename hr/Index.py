@@ -22,76 +22,256 @@
 
 import os
 
+from array import array
 from lxml import etree
 
-from hojarama import Node, Persistent, pop, ROOT
+from hojarama import Node, Persistent, pop, site
+
+from hrxml import parse
+
+from Config import snapshot
+
+# Nodes and titles shared by the indices of all languages, by site root.
+# A table is emptied once it reaches INTERN_LIMIT entries, so that the
+# titles of rebuilt indices don't accumulate in a long-running process.
+INTERN_LIMIT = 1 << 18
+
+_INTERNED = {}
+
+
+def _intern(value):
+    """Return a shared copy of the node or title `value`."""
+    if value is None:
+        return None
+    table = _INTERNED.setdefault(site().root, {})
+    if len(table) >= INTERN_LIMIT:
+        table.clear()
+    return table.setdefault((type(value), value), value)
+
+
+def _parent_node(node):
+    """Return the node of the parent of `node`."""
+    if "/" in node:
+        return _intern(Node(node.rsplit("/", 1)[0]))
+    else:
+        return _intern(Node(""))
+
+
+def index_for(lang_id):
+    """Return the index for `lang_id`: sharded if so configured, else whole."""
+    if snapshot().shards:
+        return ShardedIndex(lang_id)
+    else:
+        return Index(lang_id)
+
+
+class Branch(Persistent, list):
+
+    """
+    A shard of the site index: the children of one node.
+
+    ``Branch`` is a list of (node, title) pairs for the indexed children of
+    `node`, in index order, stored below cache/indices/<lang_id>/.
+
+    """
+
+    def __init__(self, node, lang_id):
+        self.lang_id = lang_id
+        self.node = node
+        self.path = os.path.join(site().root, "cache", "indices", lang_id,
+                                 node.path(), "index.xml")
+        self.title = None
+        list.__init__(self)
+        Persistent.__init__(self)
+
+    def __repr__(self):
+        return "<Branch '%s/%s'>" % (self.node, self.lang_id)
+
+    def _build(self):
+        """Build the shard from scratch."""
+        path = os.path.join(site().root, "site", "pages",
+                            self.node.path())
+        try:
+            doc = parse(os.path.join(path, self.lang_id + ".xml"), "meta")
+        except IOError:
+            pass
+        else:
+            self.title = pop(doc.getroot(), "title")
+        try:
+            branch_index = parse(os.path.join(path, "index.xml"), "meta")
+        except IOError:
+            return
+        for page_id in [p.get("id") for p in branch_index.getroot()]:
+            page_path = os.path.join(path, page_id, self.lang_id + ".xml")
+            page = parse(page_path, "meta")
+            if not pop(page.getroot(), "hidden", False):
+                if self.node == "":
+                    node = Node(page_id)
+                else:
+                    node = Node("%s/%s" % (self.node, page_id))
+                self.append((_intern(node),
+                             _intern(pop(page.getroot(), "title"))))
+
+    def _read(self):
+        """Read the shard from an XML file."""
+        doc = parse(self.path, "cache")
+        self.title = _intern(doc.getroot().get("title"))
+        self[:] = [(_intern(Node(e.get("node"))), _intern(e.get("title")))
+                   for e in doc.getroot()]
+
+    def xml(self):
+        """Return an XML representation of the shard."""
+        branch_root = etree.Element("branch", node=self.node)
+        if self.title is not None:
+            branch_root.set("title", self.title)
+        for node, title in self:
+            page_elem = etree.Element("page", node=node)
+            if title is not None:
+                page_elem.set("title", title)
+            branch_root.append(page_elem)
+        return etree.ElementTree(branch_root)
 
 
 class Index(Persistent, list):
 
-    """Site index."""
+    """
+    Site index.
+
+    ``Index`` is a list of ``IndexRecord`` objects in preorder [each page
+    is followed by its descendants], which may also be indexed by node.
+
+    The position of each record in the list is its preorder entry number,
+    and the position of its last descendant is its exit number, so that
+    a page and all its descendants form a contiguous slice of the index.
+    Ancestry checks, subtrees and descendant counts are therefore cheap.
+
+    """
 
     def __init__(self, lang_id):
         self.lang_id = lang_id
-        self.path = os.path.join(ROOT, "cache", "indices", lang_id + ".xml")
+        self.path = os.path.join(site().root, "cache", "indices",
+                                 lang_id + ".xml")
+        self.__exits = array("l")
+        self.__positions = {}
         list.__init__(self)
         Persistent.__init__(self)
 
     def __getitem__(self, key):
-        if isinstance(key, int):
+        if isinstance(key, (int, long, slice)):
             return list.__getitem__(self, key)
         else:
-            for record in self:
-                if record.node == key:
-                    return record
-            else:
-                raise KeyError(key)
+            return list.__getitem__(self, self.position(key))
 
     def __repr__(self):
         return "<Index '%s'>" % self.lang_id
 
     def __build_branch(self, level, parent):
         """Build a branch of the index."""
-        path = os.path.join(ROOT, "site", "pages", parent.node.path())
+        path = os.path.join(site().root, "site", "pages",
+                            parent.node.path())
         try:
-            branch_index = etree.ElementTree(file=os.path.join(path,
-                                                               "index.xml"))
+            branch_index = parse(os.path.join(path, "index.xml"), "meta")
         except IOError:
             pass
         else:
             for page_id in [p.get("id") for p in branch_index.getroot()]:
                 page_path = os.path.join(path, page_id, self.lang_id + ".xml")
-                page = etree.ElementTree(file=page_path)
+                page = parse(page_path, "meta")
                 if not pop(page.getroot(), "hidden", False):
                     if parent.node == "":
-                        node = Node(page_id)
+                        node = _intern(Node(page_id))
                     else:
-                        node = Node("%s/%s" % (parent.node, page_id))
-                    title = pop(page.getroot(), "title")
+                        node = _intern(Node("%s/%s" % (parent.node, page_id)))
+                    title = _intern(pop(page.getroot(), "title"))
                     self.append(IndexRecord(level, node, parent, title))
                     self.__build_branch(level + 1, self[-1])
 
+    def __append_record(self, level, node, parent, title):
+        """Append a record read from storage [`parent` is its position]."""
+        try:
+            parent = self[int(parent)]
+        except TypeError:
+            parent = None
+        self.append(IndexRecord(level, _intern(Node(node)), parent,
+                                _intern(title)))
+
+    def __encode(self):
+        """Number the records, and find the exit number of each."""
+        self.__positions = dict((r.node, n) for (n, r) in enumerate(self))
+        self.__exits = array("l", [0] * len(self))
+        stack = []
+        for position, record in enumerate(self):
+            while stack and self[stack[-1]].level >= record.level:
+                self.__exits[stack.pop()] = position - 1
+            stack.append(position)
+        for position in stack:
+            self.__exits[position] = len(self) - 1
+
     def _build(self):
         """Build the index from scratch."""
-        path = os.path.join(ROOT, "site", "pages", self.lang_id + ".xml")
-        doc = etree.ElementTree(file=path)
-        title = pop(doc.getroot(), "title")
-        self[:] = [IndexRecord(0, Node(""), None, title)]
+        path = os.path.join(site().root, "site", "pages",
+                            self.lang_id + ".xml")
+        doc = parse(path, "meta")
+        title = _intern(pop(doc.getroot(), "title"))
+        self[:] = [IndexRecord(0, _intern(Node("")), None, title)]
         self.__build_branch(1, self[0])
+        self.__encode()
+
+    def _load(self, db):
+        """Read the index from a database."""
+        self[:] = []
+        for row in db.execute("SELECT level, node, parent, title "
+                              "FROM index_records WHERE lang_id = ? "
+                              "ORDER BY position", (self.lang_id,)):
+            self.__append_record(*row)
+        self.__encode()
 
     def _read(self):
         """Read the index from an XML file."""
         self[:] = []
-        doc = etree.ElementTree(file=self.path)
+        doc = parse(self.path, "cache")
         for record in doc.getroot():
-            level = int(record.get("level"))
-            node = Node(record.get("node"))
-            try:
-                parent = self[int(record.get("parent"))]
-            except TypeError:
-                parent = None
-            title = record.get("title")
-            self.append(IndexRecord(level, node, parent, title))
+            self.__append_record(int(record.get("level")), record.get("node"),
+                                 record.get("parent"), record.get("title"))
+        self.__encode()
+
+    def _save(self, db):
+        """Write the index to a database."""
+        db.execute("DELETE FROM index_records WHERE lang_id = ?",
+                   (self.lang_id,))
+        db.executemany("INSERT INTO index_records VALUES (?, ?, ?, ?, ?, ?)",
+                       [(self.lang_id, n, r.level, r.node,
+                         None if r.parent is None
+                         else self.position(r.parent.node), r.title)
+                        for (n, r) in enumerate(self)])
+
+    def children(self, node):
+        """Return the records of the children of `node`."""
+        position = self.position(node)
+        end = self.__exits[position]
+        position += 1
+        found = []
+        while position <= end:
+            found.append(list.__getitem__(self, position))
+            position = self.__exits[position] + 1
+        return found
+
+    def descendants(self, node):
+        """Return the number of descendants of `node`."""
+        position = self.position(node)
+        return self.__exits[position] - position
+
+    def is_ancestor(self, ancestor, node):
+        """Return True if `ancestor` is an ancestor of `node`."""
+        try:
+            position = self.position(ancestor)
+            return position < self.position(node) <= self.__exits[position]
+        except KeyError:
+            return False
+
+    def is_indexed(self, node):
+        """Return True if `node` is in the index."""
+        return node in self.__positions
 
     def next(self, node):
         """Return the next record in the index."""
@@ -101,13 +281,25 @@ class Index(Persistent, list):
         """Return the previous record in the index."""
         return self.shift(node, -1)
 
+    def position(self, node):
+        """Return the position [preorder entry number] of `node`."""
+        try:
+            return self.__positions[node]
+        except KeyError:
+            raise KeyError(node)
+
     def shift(self, node, distance):
         """Return the record `distance` items away in the index."""
         try:
-            return self[self.index(self[node]) + distance]
-        except (KeyError, ValueError, IndexError):
+            return self[self.position(node) + distance]
+        except (KeyError, IndexError):
             return None
 
+    def subtree(self, node):
+        """Return the records of `node` and all its descendants."""
+        position = self.position(node)
+        return list.__getslice__(self, position, self.__exits[position] + 1)
+
     def xml(self):
         """Return an XML representation of the index."""
         index_root = etree.Element("index")
@@ -116,7 +308,7 @@ class Index(Persistent, list):
                                       node=record.node)
             parent = record.parent
             if parent is not None:
-                page_elem.set("parent", str(self.index(parent)))
+                page_elem.set("parent", str(self.position(parent.node)))
             title = record.title
             if title is not None:
                 page_elem.set("title", title)
@@ -124,10 +316,143 @@ class Index(Persistent, list):
         return etree.ElementTree(index_root)
 
 
+class ShardedIndex(object):
+
+    """
+    Site index, loaded a branch at a time.
+
+    ``ShardedIndex`` answers the same queries as ``Index`` [apart from
+    preorder arithmetic], but reads only the ``Branch`` shards on the path
+    from the root to the nodes concerned, building them as necessary. Any
+    given node is always represented by the same ``IndexRecord``.
+
+    """
+
+    def __init__(self, lang_id):
+        self.lang_id = lang_id
+        self.__records = {}
+
+    def __getitem__(self, key):
+        if key == 0:
+            return self.__record(_intern(Node("")))
+        elif key == -1:
+            record = self[0]
+            children = self.children(record.node)
+            while children:
+                record = children[-1]
+                children = self.children(record.node)
+            return record
+        elif isinstance(key, (int, long)):
+            raise IndexError("%s supports only indices 0 and -1" % self)
+        else:
+            return self.__record(key)
+
+    def __iter__(self):
+        stack = [self[0]]
+        while stack:
+            record = stack.pop()
+            yield record
+            stack.extend(reversed(self.children(record.node)))
+
+    def __repr__(self):
+        return "<ShardedIndex '%s'>" % self.lang_id
+
+    def __record(self, node):
+        """Return the record for `node`, if it's indexed."""
+        try:
+            return self.__records[node]
+        except KeyError:
+            pass
+        if node == "":
+            title = Branch(_intern(Node("")), self.lang_id).title
+            record = IndexRecord(0, _intern(Node("")), None, title)
+            self.__records[record.node] = record
+            return record
+        else:
+            parent = self.__record(_parent_node(node))
+            for record in self.children(parent.node):
+                if record.node == node:
+                    return record
+            raise KeyError(node)
+
+    def children(self, node):
+        """Return the records of the children of `node`."""
+        parent = self.__record(node)
+        found = []
+        for child_node, title in Branch(parent.node, self.lang_id):
+            try:
+                record = self.__records[child_node]
+            except KeyError:
+                record = IndexRecord(parent.level + 1, child_node, parent,
+                                     title)
+                self.__records[child_node] = record
+            found.append(record)
+        return found
+
+    def is_ancestor(self, ancestor, node):
+        """Return True if `ancestor` is an ancestor of `node`."""
+        try:
+            record = self.__record(node).parent
+        except KeyError:
+            return False
+        while record is not None:
+            if record.node == ancestor:
+                return True
+            record = record.parent
+        return False
+
+    def is_indexed(self, node):
+        """Return True if `node` is in the index."""
+        try:
+            self.__record(node)
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def next(self, node):
+        """Return the next record in the index."""
+        try:
+            record = self.__record(node)
+        except KeyError:
+            return None
+        children = self.children(record.node)
+        if children:
+            return children[0]
+        while record.parent is not None:
+            siblings = self.children(record.parent.node)
+            position = siblings.index(record)
+            if position + 1 < len(siblings):
+                return siblings[position + 1]
+            record = record.parent
+        return None
+
+    def previous(self, node):
+        """Return the previous record in the index."""
+        try:
+            record = self.__record(node)
+        except KeyError:
+            return None
+        if record.parent is None:
+            return self[-1] # as Index.previous() does for the root page
+        siblings = self.children(record.parent.node)
+        position = siblings.index(record)
+        if position == 0:
+            return record.parent
+        record = siblings[position - 1]
+        children = self.children(record.node)
+        while children:
+            record = children[-1]
+            children = self.children(record.node)
+        return record
+
+
 class IndexRecord(object):
 
     """Site index record."""
 
+    __slots__ = ("level", "node", "parent", "title")
+
     def __init__(self, level, node, parent=None, title=None):
         self.level = level
         self.node = node
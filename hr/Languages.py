@@ -20,37 +20,90 @@
 
 """Language index."""
 
+import multiprocessing
 import os
 
+from itertools import imap
+
 from lxml import etree
 
-from hojarama import HojaramaError, Persistent, pop, ROOT, update_htaccess
+from hojarama import (HojaramaError, log, Persistent, pop, site, SitePath,
+                      update_htaccess)
 
+from hraccept import negotiate
+from hrevict import discard
 from hrio import copy_file
 from hrio import remove_file
 from hrio import write_xml
+from hrsqlite import transaction
+from hrxml import parse
 
 from Index import Index
+from PagePack import page_key
+
+CHUNK_SIZE = 64
+# Below PARALLEL_MIN pages, a process pool isn't worth starting.
+PARALLEL_MIN = 500
+PROGRESS_STEP = 1000
+
+
+def _copy_page(job):
+    """Copy the page (source, target, hide), marking it hidden if `hide`."""
+    source, target, hide = job
+    if not hide:
+        copy_file(source, target)
+    else:
+        doc = parse(source, "content")
+        doc.getroot().set("hidden", "yes")
+        write_xml(target, doc)
+    return target
 
 
 def _copy_page_heirarchy(from_lang, to_lang):
     """Copy the entire page heirarchy from `from_lang` to `to_lang`."""
     index = Index(from_lang)
-    pages = os.path.join(ROOT, "site", "pages")
-    indexed = [os.path.join(pages, p.node.path()).rstrip("/") for p in index]
-    for path, _, _ in os.walk(pages):
-        source = os.path.join(path, from_lang + ".xml")
-        target = os.path.join(path, to_lang + ".xml")
-        if copy_file(source, target) and path in indexed:
-            doc = etree.ElementTree(file=target)
-            doc.getroot().set("hidden", "yes")
-            write_xml(target, doc)
+    pages = os.path.join(site().root, "site", "pages")
+    indexed = set(os.path.join(pages, p.node.path()).rstrip("/")
+                  for p in index)
+    jobs = []
+    for path, _, files in os.walk(pages):
+        if from_lang + ".xml" in files:
+            jobs.append((os.path.join(path, from_lang + ".xml"),
+                         os.path.join(path, to_lang + ".xml"),
+                         path in indexed))
+    _each_page(_copy_page, jobs, "copied")
+
+
+def _each_page(func, jobs, verb):
+    """Call `func` for each of `jobs` [in a process pool], logging progress."""
+    total = len(jobs)
+    if total < PARALLEL_MIN:
+        pool = None
+        results = imap(func, jobs)
+    else:
+        pool = multiprocessing.Pool()
+        results = pool.imap_unordered(func, jobs, CHUNK_SIZE)
+    try:
+        for done, _ in enumerate(results, 1):
+            if done % PROGRESS_STEP == 0 or done == total:
+                log.info("%s %d of %d pages" % (verb, done, total))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _remove_page(path):
+    """Remove the page `path`."""
+    remove_file(path)
+    return path
 
 
 def _reset_index_template(lang_id):
     """Remove all cached templates and indices for `lang_id`."""
-    Persistent.reset_cache(os.path.join("index", lang_id + ".xml"))
-    template_cache = os.path.join(ROOT, "cache", "templates")
+    Persistent.reset_cache([os.path.join("indices", lang_id + ".xml"),
+                            os.path.join("indices", lang_id)])
+    template_cache = os.path.join(site().root, "cache", "templates")
     if os.path.isdir(template_cache):
         for target in os.listdir(template_cache):
             Persistent.reset_cache(os.path.join("templates", target,
@@ -69,7 +122,7 @@ class Languages(Persistent, dict):
 
     """Language index."""
 
-    path = os.path.join(ROOT, "site", "languages.xml")
+    path = SitePath("site", "languages.xml")
 
     def __init__(self):
         self.default = None
@@ -101,22 +154,40 @@ class Languages(Persistent, dict):
     def _build(self):
         """Build the language index from filenames in the page heirarchy."""
         found = set()
-        pages = os.path.join(ROOT, "site", "pages")
+        pages = os.path.join(site().root, "site", "pages")
         for _, _, files in os.walk(pages):
             found.update(f[:2] for f in files if f[2:] == ".xml")
         for lang_id in sorted(found):
             self.__append(lang_id, lang_id.upper())
         self.default = self.order[0]
 
+    def _load(self, db):
+        """Read the language index from a database."""
+        for lang_id, name, hidden, is_default in db.execute(
+                "SELECT lang_id, name, hidden, is_default FROM languages "
+                "ORDER BY position"):
+            self.__append(lang_id, name, bool(hidden))
+            if is_default:
+                self.default = lang_id
+
     def _read(self):
         """Read the language index from an XML file."""
-        doc = etree.ElementTree(file=self.path)
+        doc = parse(self.path, "cache")
         doc_root = doc.getroot()
         self.default = doc_root.get("default")
         for lang in doc_root:
             hidden = pop(lang, "hidden", False)
             self.__append(lang.get("id"), lang.get("name"), hidden)
 
+    def _save(self, db):
+        """Write the language index to a database."""
+        db.execute("DELETE FROM languages")
+        db.executemany("INSERT INTO languages VALUES (?, ?, ?, ?, ?)",
+                       [(n, lang_id, self[lang_id].name, self[lang_id].hidden,
+                         lang_id == self.default)
+                        for (n, lang_id) in enumerate(self.order)])
+
+    @transaction
     def add(self, lang_id, name, hidden=True):
         """Add language `lang_id` to the language index."""
         from Translations import Translations
@@ -129,11 +200,12 @@ class Languages(Persistent, dict):
             self.__append(lang_id, name, hidden)
             self.write()
             _copy_page_heirarchy(self.default, lang_id)
+            Persistent.reset_cache("usage.xml")
             Translations().add_language(lang_id)
             if not hidden:
                 update_htaccess()
                 Persistent.reset_cache("pages")
-                Persistent.reset_cache("hidden.xml")
+                Persistent.reset_cache(["hidden.xml", "redirects.xml"])
 
     def hide(self, lang_id):
         """Mark language `lang_id` as hidden."""
@@ -147,29 +219,19 @@ class Languages(Persistent, dict):
         else:
             self[lang_id].hidden = True
             self.visible.remove(lang_id)
-            self.write()
+            self.write(("UPDATE languages SET hidden = 1 WHERE lang_id = ?",
+                        (lang_id,)))
             update_htaccess()
             Persistent.reset_cache("pages")
             _reset_index_template(lang_id)
 
-    def http_pref(self):
-        """Return the preferred value of `lang_id`."""
-        http_accept_language = os.getenv("HTTP_ACCEPT_LANGUAGE")
-        if http_accept_language is None:
-            return self.default
-        else:
-            accept = [a.split(";") for a in http_accept_language.split(",")]
-            for lang in accept:
-                if len(lang) == 1:
-                    lang.insert(0, "q=1.0")
-                else:
-                    lang.reverse()
-                lang[1] = lang[1][:2]
-            try:
-                return max(a for a in accept if a[1] in self.visible)[1]
-            except ValueError:
-                return self.default
+    def http_pref(self, environ=None):
+        """Return the preferred value of `lang_id` [see hraccept]."""
+        environ = os.environ if environ is None else environ
+        return negotiate(environ.get("HTTP_ACCEPT_LANGUAGE"), self.visible,
+                         self.default)
 
+    @transaction
     def kill(self, lang_id):
         """remove language `lang_id` from the language index."""
         from Translations import Translations
@@ -179,17 +241,26 @@ class Languages(Persistent, dict):
         elif lang_id == self.default:
             raise HojaramaError("%s: is the default" % msg)
         else:
-            pages = os.path.join(ROOT, "site", "pages")
-            for path, _, _ in os.walk(pages):
-                remove_file(os.path.join(path, lang_id + ".xml"))
+            pages = os.path.join(site().root, "site", "pages")
+            filename = lang_id + ".xml"
+            jobs = []
+            keys = []
+            for path, _, files in os.walk(pages):
+                if filename in files:
+                    jobs.append(os.path.join(path, filename))
+                    keys.append(page_key(path[len(pages)+1:], lang_id))
+            _each_page(_remove_page, jobs, "removed")
             Translations().kill_language(lang_id)
             hidden = self[lang_id].hidden
             del self[lang_id]
             self.write()
+            _reset_index_template(lang_id)
+            Persistent.reset_cache("usage.xml")
+            discard(keys)
             if not hidden:
                 update_htaccess()
-                Persistent.reset_cache()
-                _reset_index_template(lang_id)
+                Persistent.reset_cache("pages")
+                Persistent.reset_cache(["hidden.xml", "redirects.xml"])
 
     def list(self):
         """Display a formatted list of the site languages."""
@@ -210,7 +281,8 @@ class Languages(Persistent, dict):
             raise HojaramaError("cannot rename %s: no such language" % lang_id)
         else:
             self[lang_id].name = name
-            self.write()
+            self.write(("UPDATE languages SET name = ? WHERE lang_id = ?",
+                        (name, lang_id)))
             Persistent.reset_cache("pages")
 
     def set_default(self, lang_id):
@@ -224,7 +296,8 @@ class Languages(Persistent, dict):
             raise HojaramaError("%s: already the default" % msg)
         else:
             self.default = lang_id
-            self.write()
+            self.write(("UPDATE languages SET is_default = (lang_id = ?)",
+                        (lang_id,)))
             Persistent.reset_cache("pages")
 
     def set_order(self, order):
@@ -248,10 +321,11 @@ class Languages(Persistent, dict):
         else:
             self[lang_id].hidden = False
             self.visible = [x for x in self.order if not self[x].hidden]
-            self.write()
+            self.write(("UPDATE languages SET hidden = 0 WHERE lang_id = ?",
+                        (lang_id,)))
             update_htaccess()
             Persistent.reset_cache("pages")
-            Persistent.reset_cache("hidden.xml")
+            Persistent.reset_cache(["hidden.xml", "redirects.xml"])
 
     def xml(self):
         """Return an XML representation of the language index."""
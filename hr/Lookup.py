@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+# hr/Lookup.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory-mapped site lookup table.
+
+The lookup table is a single binary file, cache/lookup.bin, written by
+``build()`` [which tools/cache calls] from the catalogues and indices.
+It lets a freshly started process answer the questions it needs to route
+a request without parsing any XML: it's mapped into memory, and each
+query reads just the few bytes concerned.
+
+Layout [all integers little-endian]:
+
+    header      HEADER
+    languages   lang_count * STRING [visible languages, in order]
+    records     record_count * RECORD, sorted by key
+    strings     UTF-8 text referred to by STRING fields
+
+A STRING is an (offset, length) pair relative to the start of the
+strings area. Each record describes one page in one language: its key is
+"<lang_id>:<node>", and its parent, next and previous fields are record
+numbers in the same table [-1 for none].
+
+"""
+
+import mmap
+import os
+import struct
+
+from hojarama import Node, pop, site
+
+import hrsqlite
+from hrio import write_binary
+from hrxml import parse
+
+from Hidden import Hidden
+from Index import Index
+from Languages import Languages
+from Redirects import Redirects
+
+MAGIC = "HRLU"
+VERSION = 1
+
+# magic, version, lang_count, default language, record_count, strings offset
+HEADER = struct.Struct("<4sHHHII")
+
+# offset, length
+STRING = struct.Struct("<IH")
+
+# key, lang, hidden, cache, position, parent, next, previous, redirect, path
+RECORD = struct.Struct("<IHBBBiiiiIHIH")
+
+_CURRENT = {}
+
+
+def _path():
+    """Return the path of the lookup table of the current site."""
+    return os.path.join(site().root, "cache", "lookup.bin")
+
+
+def _sources(languages):
+    """Return the paths of the files a lookup table is built from."""
+    root = site().root
+    if hrsqlite.active():
+        return [hrsqlite.db_path(),
+                os.path.join(root, "cache", "redirects.xml")]
+    sources = [os.path.join(root, "site", "languages.xml"),
+               os.path.join(root, "cache", "hidden.xml"),
+               os.path.join(root, "cache", "redirects.xml")]
+    for lang_id in languages:
+        sources.append(os.path.join(root, "cache", "indices",
+                                    lang_id + ".xml"))
+    return sources
+
+
+def build():
+    """Build the lookup table from scratch, and write it to disk."""
+    languages = Languages()
+    hidden = dict((l, set(nodes)) for (l, nodes) in Hidden().items())
+    redirects = Redirects()
+    top = os.path.join(site().root, "site", "pages")
+    pages = []
+    for path, _, files in os.walk(top):
+        node = Node(path[len(top)+1:])
+        for lang_id in languages.visible:
+            filename = "%s.xml" % lang_id
+            if filename in files:
+                doc = parse(os.path.join(path, filename), "meta")
+                pages.append((lang_id, node,
+                              pop(doc.getroot(), "cache", True)))
+    pages.sort(key=lambda page: ("%s:%s" % page[:2]).encode("utf-8"))
+    numbers = dict(((lang_id, node), n)
+                   for (n, (lang_id, node, _)) in enumerate(pages))
+    strings = []
+    offsets = {}
+
+    def string(text):
+        """Return the STRING fields for `text`, adding it if necessary."""
+        data = text.encode("utf-8")
+        if data not in offsets:
+            offsets[data] = offsets.get(None, 0)
+            offsets[None] = offsets[data] + len(data)
+            strings.append(data)
+        return offsets[data], len(data)
+
+    def number(lang_id, record):
+        """Return the record number of the index record `record`."""
+        if record is None:
+            return -1
+        return numbers.get((lang_id, record.node), -1)
+
+    lang_table = [STRING.pack(*string(l)) for l in languages.visible]
+    indices = dict((l, Index(l)) for l in languages.visible)
+    record_table = []
+    for lang_id, node, cache in pages:
+        index = indices[lang_id]
+        is_hidden = node in hidden[lang_id]
+        target = node
+        redirect = u""
+        try:
+            redirect_record = redirects[lang_id][node]
+        except KeyError:
+            pass
+        else:
+            target = redirect = redirect_record.target()
+            cache = cache and redirect_record.cache
+        if is_hidden:
+            cache = False
+            output = u""
+        else:
+            output = os.path.join(target.path(), lang_id + ".xhtml")
+        if index.is_indexed(node):
+            position = index.position(node)
+            parent = number(lang_id, index[node].parent)
+            following = number(lang_id, index.next(node))
+            preceding = number(lang_id, index.previous(node))
+        else:
+            position = parent = following = preceding = -1
+        key = string(u"%s:%s" % (lang_id, node))
+        record_table.append(RECORD.pack(
+            key[0], key[1], languages.visible.index(lang_id), is_hidden,
+            bool(cache), position, parent, following, preceding,
+            *(string(redirect) + string(output))))
+    strings_offset = (HEADER.size + len(lang_table) * STRING.size
+                      + len(record_table) * RECORD.size)
+    header = HEADER.pack(MAGIC, VERSION, len(lang_table),
+                         languages.visible.index(languages.default),
+                         len(record_table), strings_offset)
+    return write_binary(_path(), "".join([header] + lang_table
+                                         + record_table + strings))
+
+
+def current():
+    """Return the lookup table, or None if it's missing or out of date."""
+    path = _path()
+    try:
+        mtime = os.stat(path).st_mtime
+        if path in _CURRENT and _CURRENT[path].mtime == mtime:
+            lookup = _CURRENT[path]
+        else:
+            lookup = _CURRENT[path] = Lookup(path)
+        for source in _sources(lookup.languages):
+            if os.stat(source).st_mtime > mtime:
+                return None
+    except (EnvironmentError, ValueError):
+        return None
+    else:
+        return lookup
+
+
+class Lookup(object):
+
+    """
+    Memory-mapped site lookup table.
+
+    ``Lookup`` is a read-only view of a lookup table file. Use
+    ``current()`` rather than instantiating it directly, to get a table
+    which is known to be up to date.
+
+    """
+
+    def __init__(self, path=None):
+        path = path or _path()
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        lookup_file = open(path, "rb")
+        try:
+            self.__data = mmap.mmap(lookup_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        finally:
+            lookup_file.close()
+        (magic, version, lang_count, default, self.count,
+         self.__strings) = HEADER.unpack_from(self.__data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d lookup table"
+                             % (path, VERSION))
+        self.__records = HEADER.size + lang_count * STRING.size
+        self.languages = [self.string(*STRING.unpack_from(self.__data,
+                              HEADER.size + n * STRING.size))
+                          for n in range(lang_count)]
+        self.default = self.languages[default]
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "<Lookup '%s'>" % self.path
+
+    def __key(self, number):
+        """Return the key of record `number`, as UTF-8."""
+        offset, length = STRING.unpack_from(self.__data, self.__records
+                                            + number * RECORD.size)
+        start = self.__strings + offset
+        return self.__data[start:start+length]
+
+    def find(self, node, lang_id):
+        """Return the record for `node` in `lang_id`, or None."""
+        key = (u"%s:%s" % (lang_id, node)).encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.__key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.__key(low) == key:
+            return self.record(low)
+        return None
+
+    def record(self, number):
+        """Return record `number`, or None if `number` is -1."""
+        if number == -1:
+            return None
+        fields = RECORD.unpack_from(self.__data,
+                                    self.__records + number * RECORD.size)
+        return LookupRecord(self, number, fields)
+
+    def string(self, offset, length):
+        """Return the text stored at `offset` in the strings area."""
+        start = self.__strings + offset
+        return self.__data[start:start+length].decode("utf-8")
+
+
+class LookupRecord(object):
+
+    """Lookup table record."""
+
+    __slots__ = ("cache", "hidden", "lang_id", "lookup", "node", "number",
+                 "position", "_links", "_output", "_redirect")
+
+    def __init__(self, lookup, number, fields):
+        (key_offset, key_length, lang, hidden, cache, self.position,
+         parent, following, preceding, redirect_offset, redirect_length,
+         output_offset, output_length) = fields
+        self.lookup = lookup
+        self.number = number
+        self.lang_id = lookup.languages[lang]
+        self.node = Node(lookup.string(key_offset,
+                                       key_length).split(":", 1)[1])
+        self.hidden = bool(hidden)
+        self.cache = bool(cache)
+        self._links = (parent, following, preceding)
+        self._redirect = (redirect_offset, redirect_length)
+        self._output = (output_offset, output_length)
+
+    def __repr__(self):
+        return "<LookupRecord '%s/%s'>" % (self.node, self.lang_id)
+
+    def is_indexed(self):
+        """Return True if the page is in the index."""
+        return self.position != -1
+
+    def next(self):
+        """Return the record of the next page in the index."""
+        return self.lookup.record(self._links[1])
+
+    def output(self):
+        """Return the path of the cached page below cache/pages, or None."""
+        return self.lookup.string(*self._output) or None
+
+    def parent(self):
+        """Return the record of the parent page in the index."""
+        return self.lookup.record(self._links[0])
+
+    def previous(self):
+        """Return the record of the previous page in the index."""
+        return self.lookup.record(self._links[2])
+
+    def redirect(self):
+        """Return the final target of the page's redirection, or None."""
+        target = self.lookup.string(*self._redirect)
+        return Node(target) if target else None
@@ -27,16 +27,20 @@ import re
 from copy import deepcopy
 from lxml import etree
 
-from hojarama import INDENT, log, NS, pop, ROOT, strip_ns, WHITESPACE
+from hojarama import INDENT, log, NS, pop, SitePath, strip_ns, WHITESPACE
 
+from hrdefer import defer
+from hrevict import record_access
+from hrio import create_directory
 from hrio import link_file
+from hrio import remove_file
 from hrio import write_file
 
-from Config import Config
-from Content import Content
+from Config import snapshot
+from Content import Content, HTTP_REDIRECT
+from PagePack import page_key, page_pack
 from Template import Template
-
-CONFIG = Config()
+from Trace import Trace
 
 DOCTYPE = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"'
            ' "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">')
@@ -58,10 +62,13 @@ class Page(object):
 
     """Site page."""
 
-    root = os.path.join(ROOT, "cache", "pages")
+    root = SitePath("cache", "pages")
 
     def __init__(self, node, lang_id):
+        self.config = snapshot()
+        self.trace = Trace(self.config.trace)
         self.content = Content(node, lang_id)
+        self.trace.lap("content")
         self.lang_id = lang_id
         self.__xhtml_data = None
 
@@ -70,46 +77,99 @@ class Page(object):
 
     def __create_redirect_links(self, path):
         """Create links to items in the redirection history."""
+        if self.config.packed:
+            pack = page_pack()
+            target = page_key(self.content.node, self.lang_id)
+            for item in self.content.history:
+                item_key = page_key(item, self.lang_id)
+                if (item_key not in pack
+                    or pack.get(item_key) != self.__xhtml_data):
+                    pack.alias(item_key, target)
+            return
         for item in self.content.history:
             item_path = os.path.join(self.root, item, self.lang_id)
             for ext in "html", "xhtml":
                 link_path = "%s.%s" % (item_path, ext)
-                if not os.path.exists(link_path):
+                if os.path.islink(link_path):
+                    stale = (os.path.realpath(link_path)
+                             != os.path.realpath(path))
+                else:
+                    stale = os.path.exists(link_path)
+                if stale:
+                    remove_file(link_path) # left from an earlier rebuild
+                if not os.path.lexists(link_path):
+                    create_directory(os.path.dirname(link_path))
                     link_file(path, link_path)
 
+    def __read_cache(self, path):
+        """Return the cached page at `path` [or in the pack]."""
+        key = page_key(self.content.node, self.lang_id)
+        if self.config.packed:
+            text = page_pack().get(key)
+            if text is None:
+                raise IOError("%s is not in the pack" % path)
+        else:
+            text = codecs.open(path, "r", "utf-8").read()
+        record_access(key)
+        return text
+
+    def __write_cache(self, path):
+        """Write the page to the cache at `path` [or in the pack]."""
+        key = page_key(self.content.node, self.lang_id)
+        text = self.xhtml()
+        if self.config.packed:
+            page_pack().put(key, text)
+        else:
+            if os.path.islink(path):
+                remove_file(path) # a redirect, where a page now is
+            write_file(path, text)
+            if not os.path.lexists(path[:-5] + "html"):
+                link_file(path, path[:-5] + "html")
+        record_access(key, len(text.encode("utf-8")))
+
     def __xml(self):
         """Return an XML representation of the page."""
         t_name = pop(self.content.xml.getroot(), "template", "default")
-        xml_data = deepcopy(Template(t_name, self.lang_id).xml())
+        template = Template(t_name, self.lang_id)
+        self.trace.lap("template")
+        xml_data = deepcopy(template.xml())
+        self.trace.lap("deepcopy")
         self.__xml_root(xml_data.getroot())
         self.__xml_head(xml_data.find("//head"))
         self.__xml_body(xml_data.find("//body"))
         for meta_elem in xml_data.findall("//{%s}meta" % NS):
             self.__xml_meta(meta_elem)
+        self.trace.lap("meta")
         if self.content.node != "":
             global_nav = ("//ul[@class='%(class)s' "
                           "or starts-with(@class,'%(class)s ')]"
-                          % {"class": CONFIG.nav_class})
+                          % {"class": self.config.nav_class})
             for global_nav_elem in xml_data.xpath(global_nav):
                 self.__xml_global_nav(global_nav_elem)
+            self.trace.lap("global_nav")
         for content_elem in xml_data.getiterator("{%s}content" % NS):
             self.__xml_content(content_elem)
+        self.trace.lap("insert")
         for extension_elem in xml_data.getiterator("{%s}*" % NS):
+            name = strip_ns(extension_elem.tag)
             self.__xml_extensions(extension_elem)
+            self.trace.lap("mutate:" + name)
+        keep_empty = self.config.keep_empty
         empty = ("//body//*[not(* "             # childless descendants of body
                  "or normalize-space() "        # without non-whitespace text
                  "or contains('|%s|', concat('|', name(), '|')))]"
-                 % "|".join(CONFIG.keep_empty)) # which aren't in keep_empty
+                 % "|".join(keep_empty))        # which aren't in keep_empty
         for element in xml_data.xpath(empty):
             element.getparent().remove(element)
+        self.trace.lap("prune")
         return xml_data
 
     def __xml_body(self, element):
         """Set the id attribute on body element `element`."""
         if self.content.node == "":
-            element.set("id", CONFIG.name)
+            element.set("id", self.config.name)
         else:
-            element.set("id", "_".join([CONFIG.name]
+            element.set("id", "_".join([self.config.name]
                                        + self.content.node.split("/")))
 
     def __xml_content(self, element):
@@ -144,7 +204,7 @@ class Page(object):
                 try:
                     mutate(element, self.content.node, self.lang_id)
                 except:
-                    if CONFIG.debug_hrx:
+                    if self.config.debug_hrx:
                         raise
                     else:
                         _abort(element, "mutate() raised an exception")
@@ -193,15 +253,25 @@ class Page(object):
         element.set("xmlns", "http://www.w3.org/1999/xhtml")
         element.set("lang", self.lang_id)
 
-    def xhtml(self):
-        """Return an XHTML representation of the page."""
+    def xhtml(self, refresh=False):
+        """
+        Return an XHTML representation of the page.
+
+        If `refresh` is True, the page is rendered again even if it's in the
+        cache; the cached copy is only rewritten if it has changed.
+
+        """
         if self.__xhtml_data is None:
             path = os.path.join(self.root, self.content.node.path(),
                                 self.lang_id) + ".xhtml"
             try:
-                self.__xhtml_data = codecs.open(path, "r", "utf-8").read()
+                if refresh:
+                    raise IOError("%s is being refreshed" % path)
+                self.__xhtml_data = self.__read_cache(path)
             except IOError:
+                self.trace.lap("read")
                 text = etree.tounicode(self.__xml())
+                self.trace.lap("serialise")
                 text = WHITESPACE.sub("\n", text)
                 text = re.sub("<script ([^>]*)/>", r"<script \1></script>",
                               text)
@@ -209,11 +279,19 @@ class Page(object):
                 text = text.replace(' xmlns:hr="%s"' % NS,
                                     ' xml:lang="%s"' % self.lang_id, 1)
                 self.__xhtml_data = "%s\n%s" % (DOCTYPE, text)
+                self.trace.lap("fixup")
                 if self.content.cache:
-                    write_file(path, self.xhtml())
-                    link_file(path, path[:-5] + "html")
+                    defer(path, self.__write_cache, path)
+                    self.trace.lap("write")
+            else:
+                self.trace.lap("read")
             finally:
-                if self.content.history and self.content.cache:
-                    self.__create_redirect_links(path)
+                if (self.content.history and self.content.cache
+                    and self.config.redirect not in HTTP_REDIRECT):
+                    defer(path + " links", self.__create_redirect_links, path)
+                    self.trace.lap("write")
+            if self.trace.enabled:
+                log.info("trace node=/%s lang=%s %s"
+                         % (self.content.node, self.lang_id, self.trace))
         return self.__xhtml_data
 
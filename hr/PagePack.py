@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+# hr/PagePack.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Packed page cache.
+
+When the ``packed`` config option is set, rendered pages are stored in
+cache/pages as an append-only data file plus an index, rather than as two
+files per page and language. Redirection history is recorded as aliases,
+which hold the key of their target and are resolved through it whenever
+they're read. Since Apache can't serve pages from the pack, every request
+goes to hr/serve [or server mode].
+
+Data file, pack.<generation>.dat:
+
+    "HRPD", followed by records, each of which is
+    RECORD, key [UTF-8], data [UTF-8; for an alias, the key of its target]
+
+Index file, pack.idx, mapped into memory:
+
+    HEADER, followed by an open-addressing hash table of SLOT entries
+
+A slot holds a hash of its key and the offset of its record [plus one, so
+that zero marks an empty slot]. Writers append to the data file before
+publishing a slot, and hold an exclusive lock on pack.lock throughout, so
+readers need no lock. Compaction writes a new generation of data file,
+then atomically replaces the index; processes which have the old files
+mapped carry on using them.
+
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from hojarama import site
+
+from hrio import create_directory
+from hrio import remove_file
+
+MAGIC = "HRPK"
+DATA_MAGIC = "HRPD"
+VERSION = 1
+
+# magic, version, data file generation, slot count, slots in use
+HEADER = struct.Struct("<4sHHQQ")
+
+# key hash, record offset + 1 [0 for an empty slot]
+SLOT = struct.Struct("<QQ")
+
+# key length, data length, data offset [ALIAS for an alias]
+RECORD = struct.Struct("<HIQ")
+
+INITIAL_SLOTS = 1024
+
+TOMBSTONE = 2 ** 64 - 1
+
+ALIAS = 2 ** 64 - 1
+
+# Aliases are followed at most this many times, in case of a cycle.
+MAX_HOPS = 8
+
+_CURRENT = {}
+
+
+def _hash(key):
+    """Return the [non-zero] hash of the UTF-8 key `key`."""
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0] or 1
+
+
+def page_key(node, lang_id):
+    """Return the key of page `node` in language `lang_id`."""
+    if node == "":
+        return lang_id
+    else:
+        return "%s/%s" % (node, lang_id)
+
+
+def page_pack(directory=None):
+    """Return the page pack for `directory`, shared within this process."""
+    directory = directory or pages_directory()
+    try:
+        return _CURRENT[directory]
+    except KeyError:
+        return _CURRENT.setdefault(directory, PagePack(directory))
+
+
+def pages_directory():
+    """Return the page cache directory of the current site."""
+    return os.path.join(site().root, "cache", "pages")
+
+
+class PagePack(object):
+
+    """Packed page cache."""
+
+    def __init__(self, directory=None):
+        directory = directory or pages_directory()
+        self.directory = directory
+        self.index_path = os.path.join(directory, "pack.idx")
+        self.lock_path = os.path.join(directory, "pack.lock")
+        self.__data = None
+        self.__generation = None
+        self.__identity = None
+        self.__index = None
+        self.__lock = threading.RLock()
+        self.__slots = 0
+
+    def __contains__(self, key):
+        self.__lock.acquire()
+        try:
+            return self.__open() and self.__find(key.encode("utf-8"))[1]
+        except EnvironmentError:
+            self.__close() # replaced or removed while in use
+            return False
+        finally:
+            self.__lock.release()
+
+    def __repr__(self):
+        return "<PagePack '%s'>" % self.directory
+
+    def __close(self):
+        """Unmap the index and data files."""
+        for mapped in self.__index, self.__data:
+            if mapped is not None:
+                mapped.close()
+        self.__data = self.__generation = self.__identity = None
+        self.__index = None
+        self.__slots = 0
+
+    def __data_path(self, generation):
+        """Return the path of data file `generation`."""
+        return os.path.join(self.directory, "pack.%d.dat" % generation)
+
+    def __find(self, key_data):
+        """Return the slot number for `key_data`, and whether it's in use."""
+        key_hash = _hash(key_data)
+        mask = self.__slots - 1
+        number = key_hash & mask
+        vacant = None
+        while True:
+            slot_hash, offset = self.__slot(number)
+            if offset == 0:
+                return (number if vacant is None else vacant), False
+            elif offset == TOMBSTONE:
+                if vacant is None:
+                    vacant = number
+            elif slot_hash == key_hash and self.__key(offset - 1) == key_data:
+                return number, True
+            number = (number + 1) & mask
+
+    def __key(self, offset):
+        """Return the key of the record at `offset`."""
+        key_length, _, _ = self.__record(offset)
+        start = offset + RECORD.size
+        return self.__data[start:start+key_length]
+
+    def __locked(self, func, *args):
+        """Call `func` while holding the writer's lock."""
+        self.__lock.acquire()
+        try:
+            if not create_directory(self.directory):
+                return None
+            lock_file = open(self.lock_path, "a")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                self.__open(create=True)
+                return func(*args)
+            finally:
+                lock_file.close()
+        finally:
+            self.__lock.release()
+
+    def __map_data(self, size=0):
+        """Map the data file, remapping it if it's grown beyond `size`."""
+        if self.__data is None or len(self.__data) < size:
+            if self.__data is not None:
+                self.__data.close()
+            data_file = open(self.__data_path(self.__generation), "rb")
+            try:
+                self.__data = mmap.mmap(data_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+            finally:
+                data_file.close()
+
+    def __open(self, create=False):
+        """Map the pack, if it exists; return True if it does."""
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            self.__close()
+            if not create:
+                return False
+            self.__write_index(0, INITIAL_SLOTS, [])
+            stat = os.stat(self.index_path)
+        if (stat.st_dev, stat.st_ino) != self.__identity:
+            self.__close()
+            index_file = open(self.index_path, "r+b")
+            try:
+                self.__index = mmap.mmap(index_file.fileno(), 0)
+            finally:
+                index_file.close()
+            magic, version, self.__generation, self.__slots, _ = (
+                HEADER.unpack_from(self.__index, 0))
+            if magic != MAGIC or version != VERSION:
+                self.__close()
+                return False
+            self.__identity = (stat.st_dev, stat.st_ino)
+            self.__map_data()
+        return True
+
+    def __publish(self, number, key_hash, offset):
+        """Point slot `number` at the record at `offset`."""
+        position = HEADER.size + number * SLOT.size
+        self.__index[position:position+8] = struct.pack("<Q", key_hash)
+        self.__index[position+8:position+16] = struct.pack("<Q", offset + 1)
+
+    def __put(self, key_data, data=None, target=None):
+        """Append a record for `key_data`, and publish it."""
+        if target is not None:
+            if not self.__find(target)[1]:
+                return False
+            data = target
+        else:
+            number, found = self.__find(key_data)
+            if found:
+                _, data_length, data_offset = self.__record(
+                    self.__slot(number)[1] - 1)
+                if data_offset != ALIAS:
+                    self.__map_data(data_offset + data_length)
+                    if (self.__data[data_offset:data_offset+data_length]
+                            == data):
+                        return True # unchanged
+        data_file = open(self.__data_path(self.__generation), "ab")
+        try:
+            data_file.seek(0, os.SEEK_END)
+            offset = data_file.tell()
+            if target is None:
+                data_offset = offset + RECORD.size + len(key_data)
+            else:
+                data_offset = ALIAS
+            data_file.write(RECORD.pack(len(key_data), len(data),
+                                        data_offset) + key_data + data)
+        finally:
+            data_file.close()
+        self.__map_data(offset + 1)
+        number, found = self.__find(key_data)
+        self.__publish(number, _hash(key_data), offset)
+        if not found:
+            used = HEADER.unpack_from(self.__index, 0)[4] + 1
+            self.__index[HEADER.size-8:HEADER.size] = struct.pack("<Q", used)
+            if used * 2 > self.__slots:
+                self.__rewrite(self.__slots * 2)
+        return True
+
+    def __record(self, offset):
+        """Return the fields of the record at `offset`."""
+        if offset + RECORD.size > len(self.__data):
+            self.__map_data(offset + RECORD.size)
+        return RECORD.unpack_from(self.__data, offset)
+
+    def __resolve(self, offset):
+        """
+        Return the data length and offset of the record at `offset`,
+        following it to its target if it's an alias, or None if there's
+        no target any more.
+
+        """
+        for _ in xrange(MAX_HOPS):
+            key_length, data_length, data_offset = self.__record(offset)
+            if data_offset != ALIAS:
+                return data_length, data_offset
+            start = offset + RECORD.size + key_length
+            self.__map_data(start + data_length)
+            number, found = self.__find(self.__data[start:start+data_length])
+            if not found:
+                return None
+            offset = self.__slot(number)[1] - 1
+        return None
+
+    def __rewrite(self, slots, compact=False):
+        """Rewrite the index with `slots` slots, compacting the data too."""
+        generation = self.__generation
+        if compact:
+            live = list(self.__live_offsets())
+            generation += 1
+            data_file = open(self.__data_path(generation), "wb")
+            moved = {}
+            records = []
+            try:
+                data_file.write(DATA_MAGIC)
+                for key_data, old_offset in live:
+                    if self.__resolve(old_offset) is None:
+                        continue # alias of a discarded page
+                    _, data_length, data_offset = self.__record(old_offset)
+                    offset = data_file.tell()
+                    if data_offset == ALIAS:
+                        start = old_offset + RECORD.size + len(key_data)
+                        data_file.write(RECORD.pack(len(key_data), data_length,
+                                                    ALIAS) + key_data
+                                        + self.__data[start:
+                                                      start+data_length])
+                    elif data_offset in moved:
+                        new_offset = moved[data_offset]
+                        data_file.write(RECORD.pack(len(key_data), data_length,
+                                                    new_offset) + key_data)
+                    else:
+                        self.__map_data(data_offset + data_length)
+                        new_offset = offset + RECORD.size + len(key_data)
+                        moved[data_offset] = new_offset
+                        data_file.write(RECORD.pack(len(key_data), data_length,
+                                                    new_offset) + key_data
+                                        + self.__data[data_offset:
+                                                      data_offset+data_length])
+                    records.append((key_data, offset))
+            finally:
+                data_file.close()
+        else:
+            records = list(self.__live_offsets())
+        old_generation = self.__generation
+        self.__write_index(generation, slots, records)
+        self.__open()
+        if generation != old_generation:
+            remove_file(self.__data_path(old_generation))
+
+    def __live_offsets(self):
+        """Yield the key and record offset of each live slot."""
+        for number in xrange(self.__slots):
+            _, offset = self.__slot(number)
+            if offset not in (0, TOMBSTONE):
+                yield self.__key(offset - 1), offset - 1
+
+    def __slot(self, number):
+        """Return the contents of slot `number`."""
+        return SLOT.unpack_from(self.__index, HEADER.size + number * SLOT.size)
+
+    def __write_index(self, generation, slots, records):
+        """Write a new index for `records`, and replace the current one."""
+        data_path = self.__data_path(generation)
+        if not os.path.exists(data_path):
+            open(data_path, "wb").write(DATA_MAGIC)
+        table = bytearray(slots * SLOT.size)
+        for key_data, offset in records:
+            key_hash = _hash(key_data)
+            number = key_hash & (slots - 1)
+            while SLOT.unpack_from(table, number * SLOT.size)[1] != 0:
+                number = (number + 1) & (slots - 1)
+            SLOT.pack_into(table, number * SLOT.size, key_hash, offset + 1)
+        temp_path = "%s.%d" % (self.index_path, os.getpid())
+        index_file = open(temp_path, "wb")
+        try:
+            index_file.write(HEADER.pack(MAGIC, VERSION, generation, slots,
+                                         len(records)))
+            index_file.write(table)
+        finally:
+            index_file.close()
+        os.rename(temp_path, self.index_path)
+
+    def alias(self, key, target):
+        """Make `key` refer to the page stored for `target`."""
+        return self.__locked(self.__put, key.encode("utf-8"), None,
+                             target.encode("utf-8"))
+
+    def compact(self):
+        """Rewrite the pack, leaving out superseded and discarded records."""
+        if self.__open():
+            self.__locked(self.__rewrite, self.__slots, True)
+
+    def discard(self, key):
+        """Remove the page stored for `key`."""
+        def discard_slot(key_data):
+            """Mark the slot for `key_data` as discarded."""
+            number, found = self.__find(key_data)
+            if found:
+                position = HEADER.size + number * SLOT.size + 8
+                self.__index[position:position+8] = struct.pack("<Q",
+                                                                TOMBSTONE)
+        if self.__open():
+            self.__locked(discard_slot, key.encode("utf-8"))
+
+    def get(self, key):
+        """Return the page stored for `key`, or None."""
+        self.__lock.acquire()
+        try:
+            if not self.__open():
+                return None
+            number, found = self.__find(key.encode("utf-8"))
+            if not found:
+                return None
+            resolved = self.__resolve(self.__slot(number)[1] - 1)
+            if resolved is None:
+                return None
+            data_length, data_offset = resolved
+            self.__map_data(data_offset + data_length)
+            return self.__data[data_offset:
+                               data_offset+data_length].decode("utf-8")
+        except EnvironmentError:
+            self.__close() # replaced or removed while in use
+            return None
+        finally:
+            self.__lock.release()
+
+    def put(self, key, text):
+        """Store the page `text` for `key`."""
+        return self.__locked(self.__put, key.encode("utf-8"),
+                             text.encode("utf-8"))
+
+    def records(self):
+        """Yield the key, data offset and data length of each live page."""
+        if not self.__open():
+            return
+        for key_data, offset in self.__live_offsets():
+            resolved = self.__resolve(offset)
+            if resolved is not None:
+                data_length, data_offset = resolved
+                yield key_data, data_offset, data_length
+
+    def stats(self):
+        """Display statistics for the pack."""
+        self.__lock.acquire()
+        try:
+            if not self.__open():
+                print "no packed pages in %s" % self.directory
+                return
+            live = list(self.records())
+            size = os.path.getsize(self.__data_path(self.__generation))
+            data = sum(length for (_, offset, length)
+                       in dict((o, (k, o, l)) for (k, o, l) in live).values())
+            print "pages:      %d" % len(live)
+            print "slots:      %d" % self.__slots
+            print "data file:  %d bytes" % size
+            print "live data:  %d bytes" % data
+            print "overhead:   %.1f%%" % (100.0 * (size - data) / size)
+        finally:
+            self.__lock.release()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# hr/Redirects.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Catalogue of redirections."""
+
+import os
+
+from lxml import etree
+
+from hojarama import log, Node, Persistent, pop, site, SitePath
+
+from hrxml import parse
+
+from Languages import Languages
+
+
+def _resolve(node, found):
+    """Return the redirection chain from `node`, and whether it loops."""
+    chain = [node]
+    while chain[-1] in found:
+        target = found[chain[-1]][0]
+        chain.append(target)
+        if target in chain[:-1]:
+            return chain, True
+    return chain, False
+
+
+class Redirects(Persistent, dict):
+
+    """
+    Catalogue of redirections.
+
+    ``Redirects`` maps each language to a dictionary of ``RedirectRecord``
+    objects, keyed by the node of every page which redirects elsewhere.
+    Each record holds the complete chain of nodes followed, so that
+    ``Content`` can go straight to the final target without reading the
+    pages in between. Redirection loops are logged when the catalogue is
+    built, and left out of it.
+
+    """
+
+    path = SitePath("cache", "redirects.xml")
+
+    def __init__(self):
+        dict.__init__(self)
+        for lang_id in Languages().visible:
+            self[lang_id] = {}
+        Persistent.__init__(self)
+
+    def _build(self):
+        """Build the catalogue from scratch."""
+        languages = Languages()
+        top = os.path.join(site().root, "site", "pages")
+        found = dict((lang_id, {}) for lang_id in languages.visible)
+        for path, _, files in os.walk(top):
+            for lang_id in languages.visible:
+                filename = "%s.xml" % lang_id
+                if filename in files:
+                    doc = parse(os.path.join(path, filename), "meta")
+                    if pop(doc.getroot(), "hidden", False):
+                        continue
+                    redirect = pop(doc.getroot(), "redirect")
+                    if redirect is not None:
+                        cache = pop(doc.getroot(), "cache", True)
+                        found[lang_id][Node(path[len(top)+1:])] = (
+                            Node(redirect), cache)
+        for lang_id in languages.visible:
+            for node in found[lang_id]:
+                chain, loop = _resolve(node, found[lang_id])
+                if loop:
+                    log.error("redirection loop: [%s] %s"
+                              % (lang_id, " >> ".join(chain)))
+                else:
+                    cache = all(found[lang_id][n][1] for n in chain[:-1])
+                    self[lang_id][node] = RedirectRecord(chain, cache)
+
+    def _read(self):
+        """Read the catalogue from an XML file."""
+        for redirect_elem in parse(self.path, "cache").getroot():
+            chain = [Node(redirect_elem.get("node"))]
+            chain.extend(Node(e.get("node")) for e in redirect_elem)
+            cache = pop(redirect_elem, "cache", True)
+            self[redirect_elem.get("lang")][chain[0]] = RedirectRecord(chain,
+                                                                      cache)
+
+    def xml(self):
+        """Return an XML representation of the catalogue."""
+        redirects_root = etree.Element("redirects")
+        for lang_id in Languages().visible:
+            for node, record in sorted(self[lang_id].items()):
+                redirect_elem = etree.Element("redirect", lang=lang_id,
+                                              node=node)
+                if not record.cache:
+                    redirect_elem.set("cache", "no")
+                for step in record.chain[1:]:
+                    redirect_elem.append(etree.Element("step", node=step))
+                redirects_root.append(redirect_elem)
+        return etree.ElementTree(redirects_root)
+
+
+class RedirectRecord(object):
+
+    """Redirection catalogue record."""
+
+    def __init__(self, chain, cache=True):
+        self.chain = chain
+        self.cache = cache
+
+    def __repr__(self):
+        return "<RedirectRecord '%s'>" % " >> ".join(self.chain)
+
+    def target(self):
+        """Return the final target of the redirection chain."""
+        return self.chain[-1]
@@ -23,18 +23,17 @@
 import os
 import sys
 
-from copy import deepcopy
-from glob import glob
 from lxml import etree
 
 from hojarama import (HojaramaError, log, MISSING_TEXT, NS, Persistent, pop,
-                      ROOT, strip_ns, WHITESPACE)
+                      site, strip_ns, WHITESPACE)
 
-from Config import Config
+from hrxml import parse
+
+from Config import snapshot
 from Translations import Translations
 from Index import Index
-
-CONFIG = Config()
+from Usage import Usage
 
 
 def _collapse(element):
@@ -51,7 +50,7 @@ def _global_nav(lang_id, max_level, nbsp, record=None, index=None):
     record = record or index[0]
     element = etree.Element("ul")
     if record.level < max_level:
-        for child in (r for r in index if r.parent == record):
+        for child in index.children(record.node):
             li_elem = etree.Element("li")
             a_elem = etree.Element("a", href="/%s/%s" % (child.node, lang_id))
             if child.title is None:
@@ -79,7 +78,7 @@ class Template(Persistent):
         self.__xml_data = None
         self.name = name
         self.lang_id = lang_id
-        self.path = os.path.join(ROOT, "cache", "templates", self.name,
+        self.path = os.path.join(site().root, "cache", "templates", self.name,
                                  lang_id + ".xml")
         Persistent.__init__(self)
 
@@ -88,12 +87,15 @@ class Template(Persistent):
 
     def __xml_global_nav(self, element):
         """Replace `element` with a navigation menu."""
+        if element.get("pruned", "").lower() in ("y", "yes"):
+            return # rendered for each page by extensions/global_nav.py
         element.tag = "ul"
+        nav_class = snapshot().nav_class
         existing_class = element.get("class")
         if existing_class is None:
-            element.set("class", CONFIG.nav_class)
+            element.set("class", nav_class)
         else:
-            element.set("class", "%s %s" % (CONFIG.nav_class, existing_class))
+            element.set("class", "%s %s" % (nav_class, existing_class))
         max_level = pop(element, "max_level", sys.maxint)
         nbsp = pop(element, "nbsp", False)
         element[:] = _global_nav(self.lang_id, max_level, nbsp)[:]
@@ -131,8 +133,9 @@ class Template(Persistent):
     def _build(self):
         """Build the language-specific page template from its master."""
         translations = Translations()
-        master = os.path.join(ROOT, "site", "templates", self.name + ".xml")
-        self.__xml_data = deepcopy(etree.ElementTree(file=master))
+        master = os.path.join(site().root, "site", "templates",
+                              self.name + ".xml")
+        self.__xml_data = parse(master, "content")
         for element in self.__xml_data.getiterator():
             _collapse(element)
         for tr_elem in self.__xml_data.getiterator("{%s}translate" % NS):
@@ -145,7 +148,7 @@ class Template(Persistent):
 
     def _read(self):
         """Read the template from an XML file."""
-        self.__xml_data = etree.ElementTree(file=self.path)
+        self.__xml_data = parse(self.path, "content")
 
     def xml(self):
         """Return an XML representation of the template."""
@@ -154,27 +157,11 @@ class Template(Persistent):
     @staticmethod
     def translations(return_type):
         """Return the set of all translations in use by any templates."""
-        found = return_type()
-        tr_predicate = "local-name()='translate'"
-        ns_predicate = "namespace-uri()='%s'" % NS
-        element_search = "//*[%s][%s]/@from" % (tr_predicate, ns_predicate)
-        attribute_search = "//*/@*[%s]" % ns_predicate
-        for path in glob(os.path.join(ROOT, "site", "templates", "*.xml")):
-            try:
-                template = etree.ElementTree(file=path)
-            except IOError:
-                log.warning("can't read file %s" % path)
-            except etree.XMLSyntaxError:
-                log.warning("%s is not a valid XML file" % path)
-            else:
-                if return_type is set:
-                    found.update(template.xpath(element_search))
-                    found.update(template.xpath(attribute_search))
-                elif return_type is dict:
-                    filename = os.path.basename(path)
-                    found[filename] = set(template.xpath(element_search))
-                    found[filename].update(template.xpath(attribute_search))
-                else:
-                    raise HojaramaError("return_type must be <set> or <dict>")
-        return found
-
+        usage = Usage()
+        if return_type is set:
+            return set(usage.by_term)
+        elif return_type is dict:
+            return dict((name + ".xml", set(terms))
+                        for (name, terms) in usage.items())
+        else:
+            raise HojaramaError("return_type must be <set> or <dict>")
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# hr/Trace.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Render timings."""
+
+import os
+import time
+
+ENV_VAR = "HOJARAMA_TRACE"
+
+
+class Trace(object):
+
+    """
+    Render timings.
+
+    ``Trace`` records how long each stage of rendering a page takes. Each
+    call to ``lap(stage)`` charges the time elapsed since the previous lap
+    [or since the trace began] to `stage`; repeated stages accumulate.
+
+    A trace is enabled by the ``trace`` config option, or by setting the
+    environment variable HOJARAMA_TRACE. When it's disabled, ``lap()``
+    does nothing.
+
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled or bool(os.getenv(ENV_VAR))
+        self.order = []
+        self.stages = {}
+        self.__start = self.__last = time.time()
+
+    def __repr__(self):
+        return "<Trace %s>" % ("enabled" if self.enabled else "disabled")
+
+    def __str__(self):
+        return " ".join("%s=%.2fms" % item for item in self.items())
+
+    def header(self):
+        """Return the timings formatted for a HTTP header."""
+        return ", ".join("%s=%.2f" % item for item in self.items())
+
+    def items(self):
+        """Return a list of (stage, milliseconds) pairs, including a total."""
+        items = [(stage, self.stages[stage] * 1000) for stage in self.order]
+        items.append(("total", (self.__last - self.__start) * 1000))
+        return items
+
+    def lap(self, stage):
+        """Charge the time elapsed since the previous lap to `stage`."""
+        if self.enabled:
+            now = time.time()
+            if stage not in self.stages:
+                self.order.append(stage)
+                self.stages[stage] = 0.0
+            self.stages[stage] += now - self.__last
+            self.__last = now
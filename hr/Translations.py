@@ -24,9 +24,15 @@ import os
 
 from lxml import etree
 
-from hojarama import HojaramaError, Persistent, ROOT
+from hojarama import HojaramaError, log, Persistent, SitePath
+
+from hrcatalogue import read_catalogue, write_catalogue
+from hrevict import discard
+from hrxml import parse
 
 from Languages import Languages
+from PagePack import page_key
+from Usage import Usage
 
 
 def _defaults(term):
@@ -38,33 +44,67 @@ class Translations(Persistent, dict):
 
     """Site translations."""
 
-    path = os.path.join(ROOT, "site", "translations.xml")
+    path = SitePath("site", "translations.xml")
+
+    def __invalidate(self, changed):
+        """Reset the templates and pages using `changed` [terms by lang_id]."""
+        usage = Usage()
+        targets = []
+        keys = []
+        for lang_id, terms in sorted(changed.items()):
+            names = set()
+            for term in terms:
+                names.update(usage.by_term.get(term, ()))
+            if names:
+                filename = lang_id + ".xml"
+                targets.extend(os.path.join("templates", name, filename)
+                               for name in sorted(names))
+                keys.extend(page_key(node, lang_id)
+                            for node in usage.dependents(names, lang_id))
+        Persistent.reset_cache(targets)
+        discard(keys)
 
     def _build(self):
         """Generate translations from those requested by all templates."""
-        from Template import Template
-        self.update((f, _defaults(f)) for f in Template.translations(set))
+        self.update((f, _defaults(f)) for f in Usage().by_term)
+
+    def _load(self, db):
+        """Read translations from a database."""
+        for term, lang_id, value in db.execute(
+                "SELECT term, lang_id, value FROM translations"):
+            self.setdefault(term, {})[lang_id] = value
 
     def _read(self):
         """Read translations from an XML file."""
-        doc = etree.ElementTree(file=self.path)
+        doc = parse(self.path, "cache")
         for term in doc.getroot():
             self[term.get("id")] = dict((t.get("lang"), t.get("value"))
                                         for t in term)
 
+    def _save(self, db):
+        """Write translations to a database."""
+        db.execute("DELETE FROM translations")
+        db.executemany("INSERT INTO translations VALUES (?, ?, ?)",
+                       [(term, lang_id, value)
+                        for (term, defs) in self.items()
+                        for (lang_id, value) in defs.items()])
+
     def add(self, term):
         """Add the entry `term`."""
         if term in self:
             raise HojaramaError, ("cannot add %s: already exists" % term)
         else:
             self[term] = _defaults(term)
-            self.write()
+            self.write(("INSERT INTO translations VALUES (?, ?, ?)",
+                        [(term, k, v) for (k, v) in self[term].items()]))
+            self.__invalidate(dict((k, set([term])) for k in self[term]))
 
     def add_language(self, lang_id):
         """Add default translations for language `lang_id` to all entries."""
         for term, defs in self.items():
             defs[lang_id] = term
-        self.write()
+        self.write(("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+                    [(term, lang_id, term) for term in self]))
 
     def apply(self, term, lang_id, value):
         """Set the translation of entry `term` for language `lang_id`."""
@@ -75,14 +115,27 @@ class Translations(Persistent, dict):
             raise HojaramaError("%s: no such term %s" % (msg, term))
         else:
             self[term][lang_id] = value
-            self.write()
+            self.write(("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+                        (term, lang_id, value)))
+            self.__invalidate({lang_id: set([term])})
+
+    def export(self, path):
+        """Export translations to the catalogue `path` [see hrcatalogue]."""
+        order = Languages().order
+        if path.lower().endswith(".po"):
+            lang_id = os.path.splitext(os.path.basename(path))[0]
+            if lang_id not in order:
+                raise HojaramaError("cannot export %s: no such language %s"
+                                    % (path, lang_id))
+            write_catalogue(path, self, [lang_id])
+        else:
+            write_catalogue(path, self, order)
 
     def kill(self, term):
         """Remove the entry `term`."""
-        from Template import Template
         msg = "cannot remove %s" % term
-        in_use = Template.translations(dict)
-        required = ", ".join(k for (k, v) in in_use.items() if term in v)
+        required = ", ".join("%s.xml" % name for name in
+                             sorted(Usage().by_term.get(term, ())))
         if term not in self:
             raise HojaramaError("%s: no such term" % msg)
         elif required and ", " not in required:
@@ -91,13 +144,14 @@ class Translations(Persistent, dict):
             raise HojaramaError("%s: used by templates %s" % (msg, required))
         else:
             del self[term]
-            self.write()
+            self.write(("DELETE FROM translations WHERE term = ?", (term,)))
 
     def kill_language(self, lang_id):
         """Remove translations for language `lang_id` from all entries."""
         for defs in self.values():
             del defs[lang_id]
-        self.write()
+        self.write(("DELETE FROM translations WHERE lang_id = ?",
+                    (lang_id,)))
 
     def list(self):
         """Display a formatted representation of the translations."""
@@ -108,6 +162,45 @@ class Translations(Persistent, dict):
             entries.append("\n".join((term, "=" * len(term), body)))
         print "\n\n".join(entries)
 
+    def merge(self, path):
+        """
+        Import translations from the catalogue `path` [see hrcatalogue].
+
+        Every entry is checked before anything is changed, and terms which
+        aren't yet in the translations are added, as long as a template uses
+        them. Only the templates which use changed terms, and the pages which
+        use those templates, are reset.
+
+        """
+        order = Languages().order
+        used = Usage().by_term
+        errors = []
+        changes = []
+        for line, term, lang_id, value in read_catalogue(path):
+            if lang_id not in order:
+                errors.append("line %d: no such language %s" % (line, lang_id))
+            elif term not in self and term not in used:
+                errors.append("line %d: no such term %s" % (line, term))
+            elif value != self.get(term, {}).get(lang_id):
+                changes.append((term, lang_id, value))
+        if errors:
+            raise HojaramaError("cannot import %s: %s"
+                                % (path, "; ".join(errors)))
+        if not changes:
+            return
+        rows = []
+        for term in sorted(set(t for (t, _, _) in changes) - set(self)):
+            self[term] = _defaults(term)
+            rows.extend((term, k, v) for (k, v) in self[term].items())
+        changed = {}
+        for term, lang_id, value in changes:
+            self[term][lang_id] = value
+            changed.setdefault(lang_id, set()).add(term)
+        self.write(("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+                    rows + changes))
+        self.__invalidate(changed)
+        log.info("imported %d translations from %s" % (len(changes), path))
+
     def xml(self):
         """Return an XML representation of the translations."""
         translations_root = etree.Element("translations")
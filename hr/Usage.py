@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# hr/Usage.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Catalogue of translation terms used by master templates."""
+
+import os
+
+from glob import glob
+
+from lxml import etree
+
+from hojarama import log, Node, NS, Persistent, pop, site, SitePath
+
+from hrxml import parse
+
+
+def _masters():
+    """Return the modification time of each master template, by name."""
+    found = {}
+    top = os.path.join(site().root, "site", "templates")
+    for path in glob(os.path.join(top, "*.xml")):
+        try:
+            found[os.path.basename(path)[:-4]] = os.stat(path).st_mtime
+        except OSError:
+            pass
+    return found
+
+
+def _page_templates(lang_id):
+    """Return the nodes of the pages in `lang_id`, by template name."""
+    top = os.path.join(site().root, "site", "pages")
+    filename = lang_id + ".xml"
+    found = {}
+    for path, _, files in os.walk(top):
+        if filename in files:
+            doc = parse(os.path.join(path, filename), "meta")
+            name = pop(doc.getroot(), "template", "default")
+            found.setdefault(name, set()).add(Node(path[len(top)+1:]))
+    return found
+
+
+def _terms(name):
+    """Return the set of terms used by master template `name`, or None."""
+    path = os.path.join(site().root, "site", "templates", name + ".xml")
+    tr_predicate = "local-name()='translate'"
+    ns_predicate = "namespace-uri()='%s'" % NS
+    element_search = "//*[%s][%s]/@from" % (tr_predicate, ns_predicate)
+    attribute_search = "//*/@*[%s]" % ns_predicate
+    try:
+        template = parse(path, "meta")
+    except IOError:
+        log.warning("can't read file %s" % path)
+    except etree.XMLSyntaxError:
+        log.warning("%s is not a valid XML file" % path)
+    else:
+        terms = set(template.xpath(element_search))
+        terms.update(template.xpath(attribute_search))
+        return terms
+    return None
+
+
+class Usage(Persistent, dict):
+
+    """
+    Catalogue of translation terms used by master templates.
+
+    ``Usage`` maps the name of each master template in site/templates to
+    the set of terms it uses, and ``by_term`` maps each term to the set of
+    templates which use it. The modification time of each master template
+    is recorded too, and whenever a ``Usage`` object is created, templates
+    which have changed since are read again.
+
+    ``pages`` maps a language to the nodes of its pages by template name,
+    so that the pages affected by a change of translation can be found
+    without reading them all. Each language is filled in from site/pages
+    the first time it's needed; like the other catalogues in the cache, it
+    must be reset when pages are added or their templates change.
+
+    """
+
+    path = SitePath("cache", "usage.xml")
+
+    def __init__(self):
+        dict.__init__(self)
+        self.by_term = {}
+        self.mtimes = {}
+        self.pages = {}
+        Persistent.__init__(self)
+        masters = _masters()
+        if masters != self.mtimes:
+            self.__update(masters)
+            self.write()
+
+    def __index(self):
+        """Rebuild ``by_term`` from the catalogue."""
+        self.by_term = {}
+        for name, terms in self.items():
+            for term in terms:
+                self.by_term.setdefault(term, set()).add(name)
+
+    def __update(self, masters):
+        """Read the terms of templates changed since `self.mtimes`."""
+        for name in set(self) - set(masters):
+            del self[name]
+        for name, mtime in masters.items():
+            if self.mtimes.get(name) != mtime:
+                terms = _terms(name)
+                if terms is None:
+                    self.pop(name, None)
+                else:
+                    self[name] = terms
+        self.mtimes = masters
+        self.__index()
+
+    def _build(self):
+        """Build the catalogue from scratch."""
+        self.__update(_masters())
+
+    def _read(self):
+        """Read the catalogue from an XML file."""
+        for template_elem in parse(self.path, "cache").getroot():
+            if template_elem.tag == "pages":
+                self.pages[template_elem.get("lang")] = dict(
+                    (e.get("name"), set(Node(p.get("node")) for p in e))
+                    for e in template_elem)
+                continue
+            name = template_elem.get("name")
+            self.mtimes[name] = float(template_elem.get("mtime"))
+            if template_elem.get("valid") != "no":
+                self[name] = set(t.get("id") for t in template_elem)
+        self.__index()
+
+    def dependents(self, names, lang_id):
+        """Return the nodes of pages in `lang_id` using templates `names`."""
+        if lang_id not in self.pages:
+            self.pages[lang_id] = _page_templates(lang_id)
+            self.write()
+        nodes = set()
+        for name in names:
+            nodes.update(self.pages[lang_id].get(name, ()))
+        return sorted(nodes)
+
+    def xml(self):
+        """Return an XML representation of the catalogue."""
+        usage_root = etree.Element("usage")
+        for name, mtime in sorted(self.mtimes.items()):
+            template_elem = etree.Element("template", name=name,
+                                          mtime=repr(mtime))
+            if name in self:
+                for term in sorted(self[name]):
+                    template_elem.append(etree.Element("term", id=term))
+            else:
+                template_elem.set("valid", "no")
+            usage_root.append(template_elem)
+        for lang_id, templates in sorted(self.pages.items()):
+            pages_elem = etree.SubElement(usage_root, "pages", lang=lang_id)
+            for name, nodes in sorted(templates.items()):
+                template_elem = etree.SubElement(pages_elem, "template",
+                                                 name=name)
+                for node in sorted(nodes):
+                    etree.SubElement(template_elem, "page", node=node)
+        return etree.ElementTree(usage_root)
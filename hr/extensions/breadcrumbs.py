@@ -76,7 +76,7 @@ from lxml import etree
 
 from hojarama import MISSING_TEXT, pop
 
-from Index import Index
+from Index import index_for
 
 
 def _add_affix(element, affix, position):
@@ -115,7 +115,7 @@ def _add_trail(element, record, lang_id, separator, default_text, root_text):
 def mutate(element, node, lang_id):
     """Transform the hr:breadcrumbs element `element`."""
     element.tag = pop(element, "tag", "p")
-    index = Index(lang_id)
+    index = index_for(lang_id)
     current = pop(element, "current", True)
     default_text = pop(element, "default_text", MISSING_TEXT)
     min_level = pop(element, "min_level", 0)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# hr/extensions/global_nav.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A pruned navigation menu.
+
+Convert e.g. ::
+
+    <hr:global_nav pruned="yes"/>
+
+on the page /news/2007/en to::
+
+    <ul class="nav">
+      <li class="ancestor branch"><a href="/news/en">News</a>
+        <ul>
+          <li class="branch"><a href="/news/2006/en">2006</a></li>
+          <li class="branch self"><strong>2007</strong>
+            <ul>
+              <li class="leaf"><a href="/news/2007/02/en">February</a></li>
+              <li class="leaf"><a href="/news/2007/05/en">May</a></li>
+            </ul>
+          </li>
+        </ul>
+      </li>
+      <li class="leaf"><a href="/about/en">About</a></li>
+    </ul>
+
+Attributes
+----------
+
+============= ========= =================================================
+Name          Default   Description
+============= ========= =================================================
+max_level     [1]_      The maximum depth in the page heirarchy of pages
+                        listed in the menu.
+
+nbsp          "no"      Replace spaces in page titles with non-breaking
+                        spaces.
+
+pruned        "no"      Render the menu for each page [see Notes].
+============= ========= =================================================
+
+.. [1]  Unlimited by default.
+
+Notes
+-----
+
+Without ``pruned="yes"``, the whole menu is built once into each
+language-specific template, and every page carries a copy of it.
+
+A pruned menu lists only the ancestors of the current page, the siblings
+of each of them, and the children of the current page, so its size
+depends on the depth of the page rather than the size of the site.
+
+The markup is otherwise the same: the class of the menu is the
+``nav_class`` config option, and the current page and its top-level
+ancestor are marked in the same way.
+
+"""
+
+import sys
+
+from lxml import etree
+
+from hojarama import MISSING_TEXT, pop
+
+from Config import snapshot
+from Index import index_for
+
+
+def _branch(index, record, lang_id, max_level, nbsp):
+    """Return a list of links to the children of `record`."""
+    ul_elem = etree.Element("ul")
+    for child in index.children(record.node):
+        branch = child.level < max_level and bool(index.children(child.node))
+        li_elem = etree.Element("li")
+        a_elem = etree.Element("a", href="/%s/%s" % (child.node, lang_id))
+        if child.title is None:
+            a_elem.text = MISSING_TEXT
+        elif nbsp:
+            a_elem.text = child.title.replace(" ", unichr(160))
+        else:
+            a_elem.text = child.title
+        li_elem.append(a_elem)
+        li_elem.set("class", "branch" if branch else "leaf")
+        ul_elem.append(li_elem)
+    return ul_elem
+
+
+def mutate(element, node, lang_id):
+    """Transform the hr:global_nav element `element`."""
+    nav_class = snapshot().nav_class
+    element.tag = "ul"
+    existing_class = element.get("class")
+    if existing_class is None:
+        element.set("class", nav_class)
+    else:
+        element.set("class", "%s %s" % (nav_class, existing_class))
+    max_level = pop(element, "max_level", sys.maxint)
+    nbsp = pop(element, "nbsp", False)
+    pop(element, "pruned")
+    index = index_for(lang_id)
+    record = index[0]
+    if record.level >= max_level:
+        return
+    element[:] = _branch(index, record, lang_id, max_level, nbsp)[:]
+    if node == "":
+        return
+    steps = node.split("/")
+    path = ["/".join(steps[:n]) for n in range(1, len(steps) + 1)]
+    ul_elem = element
+    for level, ancestor in enumerate(path):
+        for li_elem in ul_elem:
+            if li_elem[0].get("href") == "/%s/%s" % (ancestor, lang_id):
+                break
+        else:
+            return # ancestor is unindexed
+        record = index[ancestor]
+        if ancestor == node:
+            li_elem.attrib["class"] += " self"
+            li_elem[0].tag = "strong"
+            del li_elem[0].attrib["href"]
+        elif level == 0 and li_elem.get("class") == "branch":
+            li_elem.set("class", "ancestor branch")
+        if li_elem.get("class").startswith("leaf"):
+            return
+        ul_elem = _branch(index, record, lang_id, max_level, nbsp)
+        li_elem.append(ul_elem)
@@ -60,17 +60,16 @@ from hojarama import pop
 from Hidden import Hidden
 from Languages import Languages
 
-HIDDEN = Hidden()
-LANGUAGES = Languages()
-
 
 def mutate(element, node, page_lang_id):
     """Transform the hr:lang_menu element `element`."""
     element.tag = "ul"
     include_hidden = pop(element, "include_hidden", True)
-    for lang_id in LANGUAGES.visible:
+    hidden = Hidden()
+    languages = Languages()
+    for lang_id in languages.visible:
         li_elem = etree.Element("li")
-        if node in HIDDEN[lang_id]:
+        if node in hidden[lang_id]:
             if include_hidden:
                 language_elem = etree.Element("del")
             else:
@@ -80,7 +79,7 @@ def mutate(element, node, page_lang_id):
         else:
             language_elem = etree.Element("a", href=lang_id, hreflang=lang_id,
                                           rel="alternate")
-        language_elem.text = LANGUAGES[lang_id].name
+        language_elem.text = languages[lang_id].name
         li_elem.append(language_elem)
         element.append(li_elem)
 
@@ -64,12 +64,12 @@ inside the <head> section of the page.
 
 from hojarama import pop
 
-from Index import Index
+from Index import index_for
 
 
 def _target_page(element, node, lang_id):
     """Return the index record for the specified relation's target page."""
-    index = Index(lang_id)
+    index = index_for(lang_id)
     relation = element.get("rel")
     if relation in ("contents", "first", "home", "index", "start"):
         return index[0]
@@ -75,7 +75,7 @@ from lxml import etree
 
 from hojarama import MISSING_TEXT, pop
 
-from Index import Index
+from Index import index_for
 
 
 def _add_dt(element, tag, record, lang_id=""):
@@ -109,14 +109,14 @@ def mutate(element, node, lang_id):
     element.tag = "dl"
     min_level = pop(element, "min_level", 0)
     min_level_childless = pop(element, "min_level_childless")
-    index = Index(lang_id)
+    index = index_for(lang_id)
     try:
         record = index[node]
     except KeyError:
         element.getparent().remove(element)
         return # page is unindexed
     if record.level >= min_level:
-        children = [r for r in index if r.parent == record]
+        children = index.children(node)
         if children:
             _add_dt(element, "strong", record)
             _populate(element, children, lang_id)
@@ -126,6 +126,6 @@ def mutate(element, node, lang_id):
             element.getparent().remove(element)
         else:
             _add_dt(element, "a", record.parent, lang_id)
-            siblings = [r for r in index if r.parent == record.parent]
+            siblings = index.children(record.parent.node)
             _populate(element, siblings, lang_id, record)
 
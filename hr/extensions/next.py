@@ -67,12 +67,12 @@ from lxml import etree
 
 from hojarama import HojaramaError, MISSING_TEXT, pop
 
-from Index import Index
+from Index import index_for
 
 
 def _details(element, node, lang_id):
     """Return appropriate prefix, target and text for `element`."""
-    index = Index(lang_id)
+    index = index_for(lang_id)
     default_text = pop(element, "default_text", MISSING_TEXT)
     prefix = pop(element, "prefix")
     loop = pop(element, "loop", False)
@@ -84,7 +84,7 @@ def _details(element, node, lang_id):
     unindexed_target = pop(element, "unindexed_target", "")
     unindexed_text = pop(element, "unindexed_text",
                          index[0].title or default_text)
-    if node in (r.node for r in index):
+    if index.is_indexed(node):
         next = index.next(node)
         if next is not None:
             return (prefix, next.node, next.title or default_text)
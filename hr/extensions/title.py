@@ -72,21 +72,21 @@ tag           "h1"              Tag name of the resulting element. [4]_
 import os
 import re
 
-from lxml import etree
+from hojarama import pop, site
 
-from hojarama import pop, ROOT
+from hrxml import parse
 
-from Index import Index
+from Index import index_for
 
 
 def _titles(node, lang_id):
     """Return the titles of the page and its parent."""
     try:
-        record = Index(lang_id)[node]
+        record = index_for(lang_id)[node]
     except KeyError: # unindexed page
-        path = os.path.join(ROOT, "site", "pages", node.path(),
+        path = os.path.join(site().root, "site", "pages", node.path(),
                             lang_id + ".xml")
-        doc = etree.ElementTree(file=path)
+        doc = parse(path, "meta")
         return pop(doc.getroot(), "title"), None
     else:
         if record.parent is None:
@@ -25,6 +25,12 @@ import logging
 import os
 import re
 import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from hrio import remove_directory, remove_file, write_file, write_xml
 
@@ -35,12 +41,14 @@ ROOT = os.path.abspath(os.path.join(sys.path[0], os.pardir))
 VERSION = "0.08.01"
 WHITESPACE = re.compile("( *\n)+")
 
+_LOCAL = threading.local()
+
 
 def _start_logger():
     """Start logging services."""
-    from Config import Config
+    from Config import snapshot
     logger = logging.getLogger("Hojarama")
-    config = Config()
+    config = snapshot()
     logger.setLevel(config.log)
     handler = logging.StreamHandler()
     handler.setLevel(config.log)
@@ -71,6 +79,11 @@ def pop(element, attr, default=None):
             return type(default)(value)
 
 
+def site():
+    """Return the site this thread is working on [see ``Site``]."""
+    return getattr(_LOCAL, "site", None) or DEFAULT_SITE
+
+
 def strip_ns(text):
     """Return a tag name with the namespace prefix removed."""
     return text.rsplit("}", 1)[-1]
@@ -78,23 +91,29 @@ def strip_ns(text):
 
 def update_htaccess():
     """Update .htaccess with the domain name, site root and languages."""
-    from Config import Config
+    from Config import snapshot
     from Languages import Languages
-    config = Config()
-    path = os.path.join(ROOT, ".htaccess")
+    config = snapshot()
+    root = site().root
+    path = os.path.join(root, ".htaccess")
     text = open(path).readlines()
     after = lambda tag: 1 + text.index("### DO NOT EDIT ### %s\n" % tag)
     updates = {"cache":  "RewriteCond %s/cache/pages%%{REQUEST_URI}.xhtml -f\n"
-                         % ROOT,
+                         % root,
                "lang":   "RewriteRule /(%s)$ - [CO=lang:$1:%s:2103840]\n"
                          % ("|".join(Languages().visible), config.domain),
                "global": "RewriteCond %s/site/global%%{REQUEST_URI} -f\n"
-                         % ROOT}
+                         % root}
     for tag in updates:
         text[after(tag)] = updates[tag]
     write_file(path, "".join(text))
 
 
+def use_site(new_site):
+    """Make this thread work on `new_site` [None for the default site]."""
+    _LOCAL.site = new_site
+
+
 class Node(str):
 
     """
@@ -107,6 +126,8 @@ class Node(str):
 
     # NB: Not tested in environments other than POSIX.
 
+    __slots__ = ()
+
     pathsep = os.path.sep
     pardir = os.pardir
 
@@ -128,6 +149,45 @@ class HojaramaError(Exception):
     """Something, somewhere, has gone horribly wrong ..."""
 
 
+class Site(object):
+
+    """
+    A site, identified by its root directory.
+
+    Each thread works on one site at a time: the default site [whose root
+    is ROOT], unless ``use_site()`` says otherwise. Paths to site data and
+    the cache are taken from the root of the current site [see
+    ``SitePath``], and each site has its own in-memory cache of
+    ``Persistent`` objects, ``memo``.
+
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.memo = {}
+
+    def __repr__(self):
+        return "<Site '%s'>" % self.root
+
+
+class SitePath(object):
+
+    """
+    A path below the root of the current site.
+
+    ``SitePath`` is a descriptor: as a class attribute, it gives the path
+    joined from its parts and the root of the site the current thread is
+    working on.
+
+    """
+
+    def __init__(self, *parts):
+        self.parts = parts
+
+    def __get__(self, obj, cls=None):
+        return os.path.join(site().root, *self.parts)
+
+
 class Persistent(object):
 
     """
@@ -146,45 +206,106 @@ class Persistent(object):
     Any method on a subclass of ``Persistent`` which modifies the object
     must call ``self.write()`` to update the cache with the changes.
 
+    The in-memory cache holds a shallow copy of the contents of the most
+    recently stored object, so that changes made to an object but not
+    written never reach later instances. The copy shares its items, such as
+    the interned records of an index, with the object.
+
+    Subclasses may also implement ``_load(self, db)`` and ``_save(self,
+    db)``, in which case the object is stored in an SQLite database rather
+    than its XML file when the ``backend`` config option is "sqlite" [see
+    hrsqlite.py]. ``self.path`` then only identifies the object; if the
+    database doesn't hold it yet, it's read from its XML file if that
+    exists, and built from source data otherwise.
+
+    XML files are written one at a time, under a lock on site/.lock. An
+    object read from its XML file can't be written back if another process
+    has changed the file since: ``write()`` raises ``HojaramaError``
+    rather than lose the other process's changes.
+
+    Objects are cached in memory per site [see ``Site``], by path.
+
+    Between ``Persistent.begin_batch()`` and ``Persistent.end_batch()``,
+    writing an object to an XML file and resetting the cache are deferred:
+    objects written in the meantime are retrieved from memory, and at the
+    end of the batch, each is written and each part of the cache is reset
+    only once. Anything else done in the meantime, such as copying pages or
+    rewriting .htaccess, is not deferred, and is not undone if the batch
+    fails.
+
     """
 
+    lock_path = SitePath("site", ".lock")
+
     path = None
 
-    __memo = {}
+    __base = None # version of the XML file the object was read from
+    __batch = {}
 
     def __init__(self):
-        if os.path.exists(self.path):
-            if (self.path in self.__memo and self.__memo[self.path]["mtime"]
-                                             >= os.stat(self.path).st_mtime):
-                self.__retrieve()
-            else:
+        pending = self.__batch.get("objects", {}).get(self.path)
+        if pending is not None:
+            self.__retrieve(pending)
+            return
+        db = self._database()
+        version = self.__version(db)
+        memo = site().memo.get(self.path)
+        if version is None:
+            if db is not None and os.path.exists(self.path):
                 self._read()
-                self.__store()
-        else:
-            self._build()
+            else:
+                self._build()
             self.write()
+        elif memo is not None and (memo["version"] == version or
+                                   (db is None and memo["version"] >= version)):
+            self.__retrieve(memo)
+        else:
+            if db is None:
+                self._read()
+            else:
+                self._load(db)
+            self.__store()
 
-    def __retrieve(self):
-        """Retrieve the object from memory."""
-        item = self.__memo[self.path]
+    def __retrieve(self, item):
+        """Retrieve the object from memory [the memo or batch `item`]."""
         self.__dict__.update(item["attrs"])
         for base_class in self.__class__.__bases__:
             if base_class is not Persistent:
-                base_class.__init__(self, item[base_class])
+                base_class.__init__(self, item.get(base_class,
+                                                   item.get("object")))
+
+    def __check_version(self):
+        """Raise HojaramaError if the XML file changed since it was read."""
+        version = self.__version(None)
+        memo = site().memo.get(self.path)
+        if (self.__base is not None and version is not None
+            and version != self.__base
+            and (memo is None or version != memo["version"])):
+            raise HojaramaError("cannot write %s: it has been changed by "
+                                "another process" % self.path)
 
     def __store(self):
         """Store the object to memory."""
-        try:
-            mtime = os.stat(self.path).st_mtime
-        except OSError:
-            #log.warning("cannot store persistent object %s: file error" % self)
-            pass
-        else:
-            item = {"attrs": self.__dict__, "mtime": mtime}
+        db = self._database()
+        version = self.__version(db)
+        self.__base = version if db is None else None
+        if version is not None:
+            item = {"attrs": dict(self.__dict__), "version": version}
             for base_class in self.__class__.__bases__:
                 if base_class is not Persistent:
                     item[base_class] = base_class(self)
-            self.__memo[self.path] = item
+            site().memo[self.path] = item
+
+    def __version(self, db):
+        """Return the version [mtime or generation] of the stored object."""
+        if db is None:
+            try:
+                return os.stat(self.path).st_mtime
+            except OSError:
+                return None
+        else:
+            import hrsqlite
+            return hrsqlite.generation(self.path)
 
     def _build(self):
         """Build the object from scratch."""
@@ -194,9 +315,41 @@ class Persistent(object):
         """Read the object from an XML file."""
         raise NotImplementedError
 
-    def write(self):
-        """Write the object to an XML file."""
-        write_xml(self.path, self.xml(), pretty=True)
+    def _database(self):
+        """Return the SQLite connection storing the object, or None."""
+        if hasattr(self, "_load"):
+            import hrsqlite
+            if hrsqlite.active():
+                return hrsqlite.connection()
+        return None
+
+    def write(self, *changes):
+        """
+        Write the object to an XML file or database.
+
+        In a database, each of `changes` [(statement, parameters) pairs] is
+        executed instead of saving the whole object, if any are given.
+
+        """
+        db = self._database()
+        if db is None and self.__batch:
+            objects = self.__batch["objects"]
+            if self.path not in objects:
+                self.__batch["order"].append(self.path)
+            objects[self.path] = {"attrs": self.__dict__, "object": self}
+            return
+        if db is None:
+            lock_file = open(self.lock_path, "a")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                self.__check_version()
+                write_xml(self.path, self.xml(), pretty=True, sync=True)
+            finally:
+                lock_file.close()
+        else:
+            import hrsqlite
+            hrsqlite.save(self, changes)
         self.__store()
 
     def xml(self):
@@ -204,27 +357,70 @@ class Persistent(object):
         raise NotImplementedError
 
     @staticmethod
-    def reset_cache(arg=None):
-        """Remove `arg` from the cache, or the whole cache if `arg` is None."""
-        cache_path = os.path.join(ROOT, "cache")
+    def begin_batch():
+        """Defer writing to XML files and resetting the cache [see above]."""
+        Persistent.__batch.update(objects={}, order=[], resets=[])
+
+    @staticmethod
+    def end_batch():
+        """Make the writes and cache resets deferred since the batch began."""
+        batch = dict(Persistent.__batch)
+        Persistent.__batch.clear()
+        for path in batch["order"]:
+            batch["objects"][path]["object"].write()
+        resets = []
+        for arg, keep in batch["resets"]:
+            for item in arg if isinstance(arg, (list, tuple)) else [arg]:
+                if (item, keep) not in resets:
+                    resets.append((item, keep))
+        if (None, None) in resets:
+            resets = [(None, None)]
+        for item, keep in resets:
+            Persistent.reset_cache(item, keep)
+
+    @staticmethod
+    def reset_cache(arg=None, keep=None):
+        """
+        Remove `arg` from the cache, or the whole cache if `arg` is None,
+        except for `keep` [a path within the cache] and anything below it.
+
+        """
+        if Persistent.__batch:
+            Persistent.__batch["resets"].append((arg, keep))
+            return
+        cache_path = os.path.join(site().root, "cache")
         if isinstance(arg, (list, tuple)):
             for item in arg:
-                Persistent.reset_cache(item)
+                Persistent.reset_cache(item, keep)
             return
         elif arg is None:
             target_path = cache_path
         else:
             target_path = os.path.normpath(os.path.join(cache_path, arg))
+        if keep is None:
+            kept = lambda path: False
+        else:
+            keep_path = os.path.normpath(os.path.join(cache_path, keep))
+            kept = lambda path: (path == keep_path
+                                 or path.startswith(keep_path + os.sep)
+                                 or keep_path.startswith(path + os.sep))
         if target_path.startswith(cache_path) and os.path.exists(target_path):
             if os.path.isdir(target_path):
                 for path, dirs, files in os.walk(target_path, topdown=False):
                     for target in files:
-                        remove_file(os.path.join(path, target))
+                        if not kept(os.path.join(path, target)):
+                            remove_file(os.path.join(path, target))
                     for target in dirs:
-                        remove_directory(os.path.join(path, target))
+                        if not kept(os.path.join(path, target)):
+                            remove_directory(os.path.join(path, target))
             else:
                 remove_file(target_path)
+        import hrsqlite
+        if target_path.startswith(cache_path) and hrsqlite.active():
+            hrsqlite.forget(target_path)
+
 
+DEFAULT_SITE = Site(ROOT)
 
 log = _start_logger()
 
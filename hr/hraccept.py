@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# hr/hraccept.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Accept-Language negotiation.
+
+``negotiate(header, available, default)`` chooses one of the language
+identifiers `available` for an Accept-Language header [RFC 7231 5.3.5].
+Language ranges are tried in order of quality, and within the same quality
+in the order given; each is matched by "lookup" [RFC 4647 3.4], so that
+"es-AR" falls back to "es". A range of "*" matches any available language,
+and a range with a quality of 0 rules out the language it names. Malformed
+ranges and quality values are ignored. If nothing matches, the result is
+`default`.
+
+Real traffic carries few distinct headers, so results are kept in a memo
+of at most MEMO_SIZE entries, least recently used first out.
+
+Responses whose language has been negotiated should carry VARY, so that
+downstream caches key them by Accept-Language too.
+
+"""
+
+import re
+import threading
+
+from collections import OrderedDict
+
+LANGUAGE_RANGE = re.compile(r"^(\*|[a-z]{1,8}(-[a-z0-9]{1,8})*)$")
+QVALUE = re.compile(r"^(0(\.[0-9]{0,3})?|1(\.0{0,3})?)$")
+
+MEMO_SIZE = 4096
+
+VARY = ("Vary", "Accept-Language")
+
+_LOCK = threading.Lock()
+_MEMO = OrderedDict()
+
+
+def _lookup(ranges, available, default):
+    """Return the best language in `available` for `ranges`, or `default`."""
+    excluded = set(tag for (tag, quality) in ranges if not quality)
+    for tag, quality in ranges:
+        if not quality:
+            break
+        elif tag == "*":
+            for lang_id in available:
+                if lang_id not in excluded:
+                    return lang_id
+            continue
+        subtags = tag.split("-")
+        while subtags:
+            candidate = "-".join(subtags)
+            if candidate in available and candidate not in excluded:
+                return candidate
+            subtags.pop()
+    return default
+
+
+def negotiate(header, available, default):
+    """Return the language in `available` best matching `header`."""
+    if not header:
+        return default
+    key = (header, tuple(available), default)
+    _LOCK.acquire()
+    try:
+        if key in _MEMO:
+            result = _MEMO.pop(key)
+            _MEMO[key] = result
+            return result
+    finally:
+        _LOCK.release()
+    result = _lookup(parse(header), available, default)
+    _LOCK.acquire()
+    try:
+        _MEMO[key] = result
+        while len(_MEMO) > MEMO_SIZE:
+            _MEMO.popitem(last=False)
+    finally:
+        _LOCK.release()
+    return result
+
+
+def parse(header):
+    """Return (range, quality) for each language range, best first."""
+    found = []
+    for position, item in enumerate(header.split(",")):
+        params = item.split(";")
+        tag = params[0].strip().lower()
+        if not LANGUAGE_RANGE.match(tag):
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                value = value.strip()
+                quality = float(value) if QVALUE.match(value) else None
+        if quality is not None:
+            found.append((-quality, position, tag))
+    found.sort()
+    return [(tag, -quality) for (quality, _, tag) in found]
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# hr/hrcatalogue.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Translation catalogue files.
+
+The format of a catalogue is given by its filename extension:
+
+.csv    A header row of "term" followed by language identifiers, then a row
+        for each term with its translations. Empty cells are ignored when
+        reading.
+
+.po     A gettext-style catalogue for a single language, identified by the
+        "Language:" header or, failing that, by the filename [e.g. es.po].
+        Each msgid is a term, and each msgstr its translation. Entries with
+        an empty msgstr are ignored when reading.
+
+All catalogues are encoded in UTF-8.
+
+"""
+
+import codecs
+import csv
+import os
+import re
+
+from cStringIO import StringIO
+
+from hojarama import HojaramaError
+
+from hrio import write_file
+
+PO_ESCAPES = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\t": "\\t"}
+PO_KEYWORD = re.compile(r'^(msgctxt|msgid|msgstr)\s+(".*")$')
+PO_UNESCAPES = dict((v[1], k) for (k, v) in PO_ESCAPES.items())
+
+
+def _format(path):
+    """Return the format of the catalogue `path` ["csv" or "po"]."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in (".csv", ".po"):
+        raise HojaramaError("cannot use catalogue %s: unknown format %s"
+                            % (path, extension or "[no extension]"))
+    return extension[1:]
+
+
+def _po_entries(lines):
+    """Yield the line number, msgid and msgstr of each entry in `lines`."""
+    entry = {}
+    keyword = None
+    for number, line in enumerate(lines):
+        line = line.strip()
+        match = PO_KEYWORD.match(line)
+        if match is not None:
+            keyword, text = match.groups()
+            if keyword != "msgstr" and "msgstr" in entry:
+                yield entry["line"], entry.get("msgid"), entry["msgstr"]
+                entry = {}
+            entry.setdefault("line", number + 1)
+            entry[keyword] = _po_unquote(text)
+        elif line.startswith('"') and keyword in entry:
+            entry[keyword] += _po_unquote(line)
+        elif line and not line.startswith("#"):
+            raise HojaramaError("line %d: cannot parse %r" % (number + 1,
+                                                              line))
+    if "msgstr" in entry:
+        yield entry["line"], entry.get("msgid"), entry["msgstr"]
+
+
+def _po_quote(text):
+    """Return `text` as a quoted PO string."""
+    return '"%s"' % "".join(PO_ESCAPES.get(c, c) for c in text)
+
+
+def _po_unquote(text):
+    """Return the text of the quoted PO string `text`."""
+    return re.sub(r'\\(.)', lambda m: PO_UNESCAPES.get(m.group(1),
+                                                       m.group(1)),
+                  text[1:-1])
+
+
+def _read_csv(lines):
+    """Return (line, term, lang_id, value) for each translation in `lines`."""
+    rows = csv.reader(lines)
+    try:
+        header = [cell.decode("utf-8").strip() for cell in rows.next()]
+    except StopIteration:
+        return []
+    if not header or header[0] != "term":
+        raise HojaramaError("line 1: the first column must be 'term'")
+    entries = []
+    for row in rows:
+        cells = [cell.decode("utf-8") for cell in row]
+        if not cells or not cells[0].strip():
+            continue
+        for lang_id, value in zip(header[1:], cells[1:]):
+            if value:
+                entries.append((rows.line_num, cells[0].strip(), lang_id,
+                                value))
+    return entries
+
+
+def _read_po(lines, path):
+    """Return (line, term, lang_id, value) for each translation in `lines`."""
+    entries = []
+    lang_id = os.path.splitext(os.path.basename(path))[0]
+    for number, msgid, msgstr in _po_entries(lines):
+        if msgid == "":
+            for header in msgstr.split("\n"):
+                if header.lower().startswith("language:"):
+                    lang_id = header.split(":", 1)[1].strip()
+        elif msgid is not None and msgstr:
+            entries.append((number, msgid, lang_id, msgstr))
+    return entries
+
+
+def read_catalogue(path):
+    """Return (line, term, lang_id, value) for each translation in `path`."""
+    file_format = _format(path)
+    try:
+        data = open(path, "rb").read()
+    except IOError, e:
+        raise HojaramaError("cannot read catalogue %s: %s" % (path,
+                                                              e.strerror))
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+    lines = data.splitlines(True)
+    try:
+        if file_format == "csv":
+            return _read_csv(lines)
+        else:
+            return _read_po([l.decode("utf-8") for l in lines], path)
+    except UnicodeDecodeError:
+        raise HojaramaError("cannot read catalogue %s: not UTF-8" % path)
+    except (csv.Error, HojaramaError), e:
+        raise HojaramaError("cannot read catalogue %s: %s" % (path, e))
+
+
+def write_catalogue(path, translations, lang_ids):
+    """Write `translations` in the languages `lang_ids` to a catalogue."""
+    if _format(path) == "csv":
+        output = StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(["term"] + list(lang_ids))
+        for term, defs in sorted(translations.items()):
+            writer.writerow([t.encode("utf-8") for t in
+                             [term] + [defs.get(l) or u"" for l in lang_ids]])
+        text = output.getvalue().decode("utf-8")
+    elif len(lang_ids) != 1:
+        raise HojaramaError("cannot write catalogue %s: a PO catalogue "
+                            "holds exactly one language" % path)
+    else:
+        blocks = ['msgid ""\nmsgstr ""\n'
+                  '"Content-Type: text/plain; charset=UTF-8\\n"\n'
+                  '"Language: %s\\n"\n' % lang_ids[0]]
+        for term, defs in sorted(translations.items()):
+            blocks.append("msgid %s\nmsgstr %s\n"
+                          % (_po_quote(term),
+                             _po_quote(defs.get(lang_ids[0]) or u"")))
+        text = "\n".join(blocks)
+    if not write_file(path, text):
+        raise HojaramaError("cannot write catalogue %s" % path)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# hr/hrdefer.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Write-behind for page cache output.
+
+By default, ``defer(key, func, *args)`` just calls ``func(*args)``. Once
+``start()`` has been called [by tools/server --write-behind], it queues the
+call instead, to be made by a background writer thread, so that a page can
+be served before it's written to the cache. Each call is made for the site
+which was current when it was deferred.
+
+At most QUEUE_SIZE calls are queued; beyond that, ``defer()`` makes the
+call itself. A call deferred with the same key as one still waiting in the
+queue replaces it, rather than being queued again.
+
+"""
+
+import threading
+
+from Queue import Full, Queue
+
+from hojarama import log, site, use_site
+
+QUEUE_SIZE = 1000
+
+_LOCK = threading.Lock()
+_PENDING = {}
+_WRITER = {"queue": None}
+
+
+def _work():
+    """Make queued calls, forever."""
+    queue = _WRITER["queue"]
+    while True:
+        key = queue.get()
+        try:
+            _LOCK.acquire()
+            try:
+                func, args, key_site = _PENDING.pop(key)
+            finally:
+                _LOCK.release()
+            try:
+                use_site(key_site)
+                func(*args)
+            except Exception, e:
+                log.error("deferred write %s failed: %s" % (key, e))
+        finally:
+            queue.task_done()
+
+
+def defer(key, func, *args):
+    """Call `func` with `args`, now or [in write-behind mode] later."""
+    queue = _WRITER["queue"]
+    if queue is not None:
+        _LOCK.acquire()
+        try:
+            if key in _PENDING:
+                _PENDING[key] = (func, args, site())
+                return
+            try:
+                queue.put_nowait(key)
+            except Full:
+                pass
+            else:
+                _PENDING[key] = (func, args, site())
+                return
+        finally:
+            _LOCK.release()
+    func(*args)
+
+
+def drain():
+    """Wait until every queued call has been made."""
+    if _WRITER["queue"] is not None:
+        _WRITER["queue"].join()
+
+
+def start(size=QUEUE_SIZE):
+    """Start write-behind mode, with a queue of `size` calls."""
+    if _WRITER["queue"] is None:
+        _WRITER["queue"] = Queue(size)
+        thread = threading.Thread(target=_work, name="write-behind")
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+# hr/hrevict.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Least-recently-used eviction from the page cache.
+
+When the ``cache_limit`` config option [in kilobytes] is non-zero, each
+page written to or served from the page cache is recorded in an access
+log, cache/pages/access.log, of fixed-size LOG_ENTRY records. Pages which
+Apache serves directly never reach Hojarama, so for the unpacked cache
+the access time of each file is taken into account too.
+
+If the cache exceeds its limit, ``evict()`` removes the least recently
+used pages until it's down to LOW_WATER of the limit. In any case it then
+rewrites the access log with one entry per page left in the cache, and
+records the size of the cache and of the log in cache/pages/evict.stamp.
+
+``record_access()`` calls ``maybe_evict()``, which runs ``evict()`` in a
+background thread, at most once every INTERVAL seconds, and only when it's
+needed. Log entries for pages written also record their size, so the size
+of the cache is estimated from the stamp and the entries logged since,
+without walking the cache; and once more than LOG_SLACK bytes have been
+logged since, the log is compacted.
+
+"""
+
+import hashlib
+import os
+import struct
+import threading
+import time
+
+from hojarama import HojaramaError, log, site, use_site
+
+from hrio import remove_file
+
+from Config import snapshot
+from PagePack import PagePack, pages_directory
+
+# key hash, time of access, bytes written [0 for a read]
+LOG_ENTRY = struct.Struct("<QII")
+
+INTERVAL = 60
+LOG_SLACK = 1 << 20
+LOW_WATER = 0.9
+
+_LOCK = threading.Lock()
+
+
+def _digest(key):
+    """Return the hash of `key` used in the access log."""
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return struct.unpack("<Q", digest[:8])[0]
+
+
+def _due():
+    """Return whether the cache may be over its limit, or its log too long."""
+    try:
+        total, compacted = [int(n) for n in open(_stamp_path()).read().split()]
+    except (IOError, ValueError):
+        return True
+    try:
+        log_file = open(_log_path(), "rb")
+    except IOError:
+        return total > _limit()
+    try:
+        log_file.seek(compacted)
+        data = log_file.read(LOG_SLACK + 1)
+    finally:
+        log_file.close()
+    if len(data) > LOG_SLACK:
+        return True
+    written = 0
+    for start in xrange(0, len(data) - LOG_ENTRY.size + 1, LOG_ENTRY.size):
+        written += LOG_ENTRY.unpack_from(data, start)[2]
+    return total + written > _limit()
+
+
+def _file_units():
+    """Return (keys, size, last access) for each page in the cache."""
+    directory = pages_directory()
+    units = []
+    for path, _, files in os.walk(directory):
+        for filename in files:
+            full_path = os.path.join(path, filename)
+            if os.path.islink(full_path):
+                if not os.path.exists(full_path):
+                    remove_file(full_path) # redirect to an evicted page
+            elif filename.endswith(".xhtml"):
+                stat = os.stat(full_path)
+                key = os.path.relpath(full_path[:-len(".xhtml")], directory)
+                units.append(([key.replace(os.sep, "/")], stat.st_size,
+                              stat.st_atime))
+    return units
+
+
+def _log_path():
+    """Return the path of the access log of the current site."""
+    return os.path.join(pages_directory(), "access.log")
+
+
+def _limit():
+    """Return the size limit of the page cache in bytes [0 for none]."""
+    return snapshot().cache_limit * 1024
+
+
+def _pack_units(pack):
+    """Return (keys, size, 0) for each item of data in `pack`."""
+    found = {}
+    for key_data, data_offset, data_length in pack.records():
+        keys, _, _ = found.setdefault(data_offset, ([], data_length, 0))
+        keys.append(key_data.decode("utf-8"))
+    return found.values()
+
+
+def _read_log():
+    """Return the time of the last logged access, keyed by key hash."""
+    access = {}
+    try:
+        data = open(_log_path(), "rb").read()
+    except IOError:
+        return access
+    for start in xrange(0, len(data) - LOG_ENTRY.size + 1, LOG_ENTRY.size):
+        key_hash, when, _ = LOG_ENTRY.unpack_from(data, start)
+        if when > access.get(key_hash, 0):
+            access[key_hash] = when
+    return access
+
+
+def _stamp_path():
+    """Return the path of the eviction time stamp of the current site."""
+    return os.path.join(pages_directory(), "evict.stamp")
+
+
+def _write_log(access, total):
+    """Replace the access log with `access`, and stamp it with `total`."""
+    log_path = _log_path()
+    temp_path = "%s.%d" % (log_path, os.getpid())
+    log_file = open(temp_path, "wb")
+    try:
+        for key_hash, when in access.iteritems():
+            log_file.write(LOG_ENTRY.pack(key_hash, when, 0))
+    finally:
+        log_file.close()
+    os.rename(temp_path, log_path)
+    stamp_file = open(_stamp_path(), "w")
+    try:
+        stamp_file.write("%d %d\n" % (total, len(access) * LOG_ENTRY.size))
+    finally:
+        stamp_file.close()
+
+
+def discard(keys):
+    """Remove the pages `keys` from the cache, with any aliases of them."""
+    keys = set(keys)
+    directory = pages_directory()
+    if not keys or not os.path.isdir(directory):
+        return
+    _LOCK.acquire()
+    try:
+        if snapshot().packed:
+            pack = PagePack()
+            for unit_keys, _, _ in _pack_units(pack):
+                if keys.intersection(unit_keys):
+                    for key in unit_keys:
+                        pack.discard(key)
+            return
+        for key in keys:
+            path = os.path.join(directory, key)
+            for ext in ".xhtml", ".html":
+                if os.path.lexists(path + ext):
+                    remove_file(path + ext)
+    finally:
+        _LOCK.release()
+
+
+def evict(limit=None):
+    """Evict least recently used pages until the cache is within `limit`."""
+    limit = _limit() if limit is None else limit
+    directory = pages_directory()
+    if not limit or not os.path.isdir(directory):
+        return 0
+    _LOCK.acquire()
+    try:
+        access = _read_log()
+        if snapshot().packed:
+            pack = PagePack()
+            units = _pack_units(pack)
+        else:
+            pack = None
+            units = _file_units()
+        total = sum(size for (_, size, _) in units)
+        evicted = 0
+        if total > limit:
+            def last_access(unit):
+                """Return the time of the last access to any of `unit`."""
+                return max([unit[2]] + [access.get(_digest(k), 0)
+                                        for k in unit[0]])
+            units.sort(key=last_access)
+            for keys, size, _ in units:
+                if total <= limit * LOW_WATER:
+                    break
+                for key in keys:
+                    if pack is None:
+                        path = os.path.join(directory, key) + ".xhtml"
+                        remove_file(path)
+                        if os.path.lexists(path[:-len("xhtml")] + "html"):
+                            remove_file(path[:-len("xhtml")] + "html")
+                    else:
+                        pack.discard(key)
+                total -= size
+                evicted += 1
+            if pack is not None:
+                pack.compact()
+            log.info("evicted %d pages from the page cache" % evicted)
+        kept = {}
+        for keys, _, _ in units[evicted:]:
+            for key_hash in (_digest(k) for k in keys):
+                if key_hash in access:
+                    kept[key_hash] = access[key_hash]
+        _write_log(kept, total)
+        return evicted
+    finally:
+        _LOCK.release()
+
+
+def maybe_evict():
+    """Start eviction in the background, if it's due."""
+    if not _limit():
+        return
+    stamp_path = _stamp_path()
+    try:
+        if os.stat(stamp_path).st_mtime > time.time() - INTERVAL:
+            return
+    except OSError:
+        pass
+    try:
+        open(stamp_path, "a").close()
+        os.utime(stamp_path, None)
+    except EnvironmentError:
+        return
+    if not _due():
+        return
+    current = site()
+    def run():
+        """Evict pages from the page cache of the current site."""
+        use_site(current)
+        evict()
+    thread = threading.Thread(target=run, name="evict")
+    thread.start()
+
+
+def record_access(key, size=0):
+    """Record an access to the cached page `key` [written, if `size`]."""
+    if not _limit():
+        return
+    try:
+        log_file = open(_log_path(), "ab")
+        try:
+            log_file.write(LOG_ENTRY.pack(_digest(key), int(time.time()),
+                                          size))
+        finally:
+            log_file.close()
+    except EnvironmentError:
+        return
+    maybe_evict()
+
+
+class PageCache(object):
+
+    """The page cache, packed or not [for tools/pages]."""
+
+    def __repr__(self):
+        return "<PageCache '%s'>" % pages_directory()
+
+    def compact(self):
+        """Compact the packed page cache."""
+        if not snapshot().packed:
+            raise HojaramaError("cannot compact: the page cache isn't packed")
+        PagePack().compact()
+
+    def evict(self):
+        """Evict least recently used pages, if the cache is over its limit."""
+        if not _limit():
+            raise HojaramaError("cannot evict: cache_limit is not set")
+        print "evicted %d pages" % evict()
+
+    def stats(self):
+        """Display page cache statistics."""
+        if snapshot().packed:
+            PagePack().stats()
+            units = _pack_units(PagePack())
+        else:
+            units = _file_units()
+            print "pages:      %d" % len(units)
+        total = sum(size for (_, size, _) in units)
+        print "size:       %d kB" % (total // 1024)
+        if _limit():
+            print "limit:      %d kB" % (_limit() // 1024)
@@ -18,13 +18,30 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
-"""Error-checking file I/O functions."""
+"""
+Error-checking file I/O functions.
+
+Files are written atomically: data goes to a temporary file in the same
+directory, which then replaces the target, so that readers in other
+processes never see a partly written file. If the target is a symbolic
+link, the file it points to is replaced rather than the link. Temporary
+files left by a crash are removed by ``remove_temp_files()``.
+
+"""
 
-import codecs
 import logging
 import os
+import re
 import shutil
 import sys
+import time
+
+from cStringIO import StringIO
+from thread import get_ident
+
+# Temporary files [see _temp_path], which are stale after TEMP_AGE seconds.
+TEMP_NAME = re.compile(r"\.\d+--?\d+\.tmp$")
+TEMP_AGE = 3600
 
 os.umask(0)
 
@@ -66,10 +83,72 @@ def on_error(msg, err=logging.WARNING):
     return decorator
 
 
+def _sync_directory(dirname):
+    """Flush the directory `dirname` to disk, so that renames in it last."""
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return # e.g. on platforms which can't open directories
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _temp_path(target):
+    """Return a temporary path for `target`, unique to the thread."""
+    return "%s.%d-%d.tmp" % (target, os.getpid(), get_ident())
+
+
+def _unchanged(target, data):
+    """Return True if the file `target` already holds the bytes `data`."""
+    try:
+        if os.path.getsize(target) != len(data):
+            return False
+        existing = open(target, "rb").read()
+    except EnvironmentError:
+        return False
+    return existing == data
+
+
+def _write(target, data, sync=False):
+    """Write the bytes `data` to a file `target`, via a temporary file."""
+    target = os.path.realpath(target)
+    dirname = os.path.dirname(target)
+    if not os.path.exists(dirname):
+        create_directory(dirname)
+    temp_path = _temp_path(target)
+    try:
+        temp_file = os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT
+                                      | os.O_TRUNC, 0666), "wb")
+        try:
+            temp_file.write(data)
+            temp_file.flush()
+            if sync:
+                os.fsync(temp_file.fileno())
+        finally:
+            temp_file.close()
+        os.rename(temp_path, target)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if sync:
+        _sync_directory(dirname)
+
+
 @on_error("unable to copy file %(1)s to %(2)s")
 def copy_file(source, target):
     """Copy the file `source` to `target`."""
-    shutil.copyfile(source, target)
+    target = os.path.realpath(target)
+    temp_path = _temp_path(target)
+    try:
+        shutil.copyfile(source, temp_path)
+        os.rename(temp_path, target)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 @on_error("unable to create directory %(1)s")
@@ -103,23 +182,54 @@ def remove_file(target):
     os.remove(target)
 
 
+def remove_temp_files(top):
+    """Remove stale temporary files below `top`, left by a crash."""
+    limit = time.time() - TEMP_AGE
+    for path, _, files in os.walk(top):
+        for filename in files:
+            if TEMP_NAME.search(filename):
+                full_path = os.path.join(path, filename)
+                try:
+                    stale = os.lstat(full_path).st_mtime < limit
+                except OSError:
+                    continue # removed by its writer meanwhile
+                if stale:
+                    remove_file(full_path)
+
+
 @on_error("unable to write file %(1)s")
-def write_file(target, data):
-    """Write `data` to a file `target`."""
-    dirname = os.path.dirname(target)
-    if not os.path.exists(dirname):
-        create_directory(dirname)
-    codecs.open(target, "w", "utf-8").write(data)
+def write_file(target, data, sync=False):
+    """
+    Write `data` to a file `target`, unless it's unchanged, flushing it to
+    disk if `sync` is True.
+
+    """
+    data = data.encode("utf-8")
+    if not _unchanged(target, data):
+        _write(target, data, sync)
+
+
+@on_error("unable to write file %(1)s")
+def write_binary(target, data, sync=False):
+    """
+    Write the byte string `data` to a file `target`, flushing it to disk if
+    `sync` is True.
+
+    """
+    _write(target, data, sync)
 
 
 @on_error("unable to write XML data %(2)s to %(1)s")
-def write_xml(target, xml_data, pretty=False):
-    """Write `xml_data` to a file `target`, optionally pretty-printed."""
-    dirname = os.path.dirname(target)
-    if not os.path.exists(dirname):
-        create_directory(dirname)
-    xml_data.write(target, xml_declaration=True, encoding="utf-8",
+def write_xml(target, xml_data, pretty=False, sync=False):
+    """
+    Write `xml_data` to a file `target`, optionally pretty-printed, unless
+    it's unchanged, flushing it to disk if `sync` is True.
+
+    """
+    output = StringIO()
+    xml_data.write(output, xml_declaration=True, encoding="utf-8",
                    pretty_print=pretty)
-    if not os.path.exists(target):
-        raise IOError # because lxml's et.write() doesn't.
+    data = output.getvalue()
+    if not _unchanged(target, data):
+        _write(target, data, sync)
 
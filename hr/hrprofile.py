@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# hr/hrprofile.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Sampling profiler support."""
+
+import cProfile
+import os
+import pstats
+import random
+import time
+
+from glob import glob
+
+from hojarama import HojaramaError, log, site
+
+from hrio import create_directory
+from hrio import remove_file
+
+from Config import snapshot
+
+DIR_ENV_VAR = "HOJARAMA_PROFILE_DIR"
+ENV_VAR = "HOJARAMA_PROFILE"
+
+
+def profile_dir():
+    """Return the directory in which profiles are stored."""
+    return os.getenv(DIR_ENV_VAR) or os.path.join(site().root, "profiles")
+
+
+def rate():
+    """Return the sampling rate N [profile one in N requests; 0 for none]."""
+    try:
+        return int(os.getenv(ENV_VAR) or snapshot().profile)
+    except ValueError:
+        log.warning("ignoring %s: not an integer" % ENV_VAR)
+        return snapshot().profile
+
+
+def run(func, node, lang_id, *args, **kwargs):
+    """Call `func` under cProfile, saving a profile for `node` in `lang_id`."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        target = profile_dir()
+        filename = "%s.%s.%d-%d.pstats" % (node.replace("/", "+") or "+",
+                                           lang_id, time.time() * 1000,
+                                           os.getpid())
+        if create_directory(target):
+            profiler.dump_stats(os.path.join(target, filename))
+
+
+def sampled():
+    """Return True for one in every N calls, on average [see ``rate()``]."""
+    n = rate()
+    return n > 0 and random.randrange(n) == 0
+
+
+class Profiles(object):
+
+    """Saved profiles."""
+
+    def __repr__(self):
+        return "<Profiles '%s'>" % profile_dir()
+
+    def __report(self, num, sort):
+        """Display the top `num` functions of all profiles merged."""
+        paths = self.paths()
+        if not paths:
+            raise HojaramaError("no profiles in %s" % profile_dir())
+        try:
+            num = int(num)
+        except ValueError:
+            raise HojaramaError("%s is not a number" % num)
+        stats = pstats.Stats(*paths)
+        print "%d profiles in %s" % (len(paths), profile_dir())
+        stats.sort_stats(sort).print_stats(num)
+
+    def clear(self):
+        """Remove all saved profiles."""
+        for path in self.paths():
+            remove_file(path)
+
+    def cumulative(self, num):
+        """Display the top `num` functions by cumulative time."""
+        self.__report(num, "cumulative")
+
+    def list(self):
+        """Display a formatted list of the saved profiles."""
+        print "NODE                            LANG  FILE"
+        for path in self.paths():
+            filename = os.path.basename(path)
+            node, lang_id, _, _ = filename.rsplit(".", 3)
+            print "%-30s  %-4s  %s" % ("/" + node.replace("+", "/").strip("/"),
+                                       lang_id, filename)
+
+    def paths(self):
+        """Return the paths of all saved profiles."""
+        return sorted(glob(os.path.join(profile_dir(), "*.pstats")))
+
+    def time(self, num):
+        """Display the top `num` functions by internal time."""
+        self.__report(num, "time")
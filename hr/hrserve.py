@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+# hr/hrserve.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Request handling, for hr/serve and server mode.
+
+``respond()`` produces the response to a request for a page, and is used
+both by hr/serve [as a CGI script] and in server mode.
+
+In server mode, ``application()`` is a WSGI application which stands in
+for Apache and .htaccess: it serves files from site/global and the page
+cache directly, redirects URLs without a trailing slash, and renders
+everything else - either in-process, or by running hr/serve as a CGI
+script. The language cookie rules in .htaccess are not emulated.
+
+One server can serve several sites: each site added with ``add_site()`` is
+served for requests whose Host header names it, and the site the server
+was started from for any other request.
+
+"""
+
+import mimetypes
+import os
+import re
+import subprocess
+import sys
+
+from hojarama import Node, site, Site, use_site
+
+from hraccept import VARY
+from hrevict import record_access
+
+from Config import snapshot
+from Content import HTTP_REDIRECT
+from Languages import Languages
+from Lookup import current
+from Page import Page
+from PagePack import page_pack
+
+HTML = "text/html"
+XHTML = "application/xhtml+xml"
+
+LANG_SUFFIX = re.compile("/[a-z]{2}$")
+
+_SITES = {}
+
+
+def _file(path, content_type=None):
+    """Return a response containing the file at `path`."""
+    content_type = content_type or (mimetypes.guess_type(path)[0]
+                                    or "application/octet-stream")
+    return "200 OK", [("Content-type", content_type)], open(path, "rb").read()
+
+
+def _lookup_response(node, lang_id, environ):
+    """Return a response from the lookup table and page cache, or None."""
+    lookup = current()
+    if lookup is None:
+        return None
+    record = lookup.find(node, lang_id)
+    if record is None:
+        return None
+    redirect = record.redirect()
+    status = HTTP_REDIRECT.get(snapshot().redirect)
+    if redirect is not None and status is not None:
+        return (status, [("Location", location(redirect, lang_id, environ))],
+                "")
+    output = record.output()
+    if record.cache and output is not None:
+        return _cached_page(output[:-len(".xhtml")], environ)
+    return None
+
+
+def _cached_page(page_key, environ):
+    """Return a response containing the cached page `page_key`, or None."""
+    content_header = ("Content-type",
+                      "%s; charset=utf-8" % content_type(environ))
+    if snapshot().packed:
+        text = page_pack().get(page_key)
+        if text is not None:
+            record_access(page_key)
+            return "200 OK", [content_header], text.encode("utf-8")
+    else:
+        top = os.path.join(site().root, "cache", "pages")
+        path = _static_path(top, "/%s.xhtml" % page_key)
+        if path is not None:
+            record_access(page_key)
+            return _file(path, content_header[1])
+    return None
+
+
+def _static_path(top, uri):
+    """Return the path of the file for `uri` below `top`, if it exists."""
+    path = os.path.normpath(top + uri)
+    if path.startswith(top) and os.path.isfile(path):
+        return path
+
+
+def add_site(host, root):
+    """Serve the site at `root` for requests to `host`."""
+    _SITES[host.lower()] = Site(root)
+
+
+def application(environ, start_response, cgi=False):
+    """Serve the request described by the WSGI environment `environ`."""
+    use_site(site_for(environ))
+    try:
+        status, headers, body = dispatch(environ, cgi)
+    finally:
+        use_site(None)
+    start_response(status, headers)
+    return [body]
+
+
+def cgi_application(environ, start_response):
+    """Serve the request in `environ`, running hr/serve as a CGI script."""
+    return application(environ, start_response, cgi=True)
+
+
+def content_type(environ):
+    """Return the content type to serve, according to HTTP_ACCEPT."""
+    http_accept = [a.split(";")[0].strip()
+                   for a in str(environ.get("HTTP_ACCEPT")).split(",")]
+    return XHTML if (XHTML in http_accept) else HTML
+
+
+def dispatch(environ, cgi=False):
+    """Return (status, headers, body) for the request in `environ`."""
+    uri = environ.get("PATH_INFO") or "/"
+    site_global = os.path.join(site().root, "site", "global")
+    path = _static_path(site_global, uri)
+    if path is not None:
+        return _file(path)
+    response = _cached_page(uri.lstrip("/"), environ)
+    if response is not None:
+        return response
+    if "." in uri:
+        path = _static_path(os.path.join(site().root, "site", "pages"),
+                            uri)
+        if path is not None:
+            return _file(path)
+        uri = "/error/404/"
+    elif not (LANG_SUFFIX.search(uri) or uri.endswith("/")):
+        return "302 Found", [("Location", uri + "/")], ""
+    if cgi:
+        return run_cgi(uri, environ)
+    else:
+        node, lang_id, vary = resolve(uri, environ)
+        status, headers, body = respond(node, lang_id, environ)
+        return status, headers + vary, body
+
+
+def location(node, lang_id, environ=None):
+    """Return the absolute URL of the page `node` in language `lang_id`."""
+    environ = os.environ if environ is None else environ
+    scheme = "https" if environ.get("HTTPS") == "on" else "http"
+    host = environ.get("HTTP_HOST") or snapshot().domain
+    if node == "":
+        return "%s://%s/%s" % (scheme, host, lang_id)
+    else:
+        return "%s://%s/%s/%s" % (scheme, host, node, lang_id)
+
+
+def respond(node, lang_id, environ=None):
+    """Return (status, headers, body) for page `node` in `lang_id`."""
+    environ = os.environ if environ is None else environ
+    if not snapshot().trace:
+        response = _lookup_response(node, lang_id, environ)
+        if response is not None:
+            return response
+    page = Page(node, lang_id)
+    redirect = page.content.redirect
+    status = HTTP_REDIRECT.get(snapshot().redirect)
+    if redirect is not None and status is not None:
+        return (status, [("Location", location(redirect, lang_id, environ))],
+                "")
+    body = page.xhtml().encode("utf-8")
+    headers = [("Content-type",
+                "%s; charset=utf-8" % content_type(environ))]
+    if page.trace.enabled:
+        headers.append(("X-Render-Timing", page.trace.header()))
+    return page.content.status(), headers, body
+
+
+def resolve(uri, environ=None):
+    """
+    Return the node and language requested by `uri` ["/node/lang"], and
+    any headers the response needs because the language was negotiated.
+
+    """
+    request_node, request_lang = uri.rsplit("/", 1)
+    node = Node(request_node.lstrip("/"))
+    lookup = current()
+    if lookup is not None and request_lang in lookup.languages:
+        return (node, request_lang, [])
+    elif lookup is None and request_lang in Languages().visible:
+        return (node, request_lang, [])
+    else:
+        return (node, Languages().http_pref(environ), [VARY])
+
+
+def route(uri, environ=None):
+    """Return the node and language requested by `uri` ["/node/lang"]."""
+    return resolve(uri, environ)[:2]
+
+
+def run_cgi(uri, environ):
+    """Return (status, headers, body) from running hr/serve on `uri`."""
+    env = dict((k, v) for (k, v) in environ.items() if isinstance(v, str))
+    serve = os.path.join(site().root, "hr", "serve")
+    process = subprocess.Popen([sys.executable, serve, uri], env=env,
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    head, _, body = output.partition("\n\n")
+    status = "500 Internal server error"
+    headers = []
+    for line in head.splitlines():
+        name, _, value = line.partition(":")
+        if name.lower() == "status":
+            status = value.strip()
+        else:
+            headers.append((name, value.strip()))
+    return status, headers, body
+
+
+def site_for(environ):
+    """Return the site named by the Host header, or None if it's unknown."""
+    host = environ.get("HTTP_HOST") or environ.get("SERVER_NAME") or ""
+    return _SITES.get(host.split(":", 1)[0].lower())
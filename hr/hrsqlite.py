@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# hr/hrsqlite.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+SQLite storage for persistent objects.
+
+When the ``backend`` config option is "sqlite", ``Persistent`` objects
+which support it are stored in site/metadata.db instead of XML files.
+Each object is identified by its path relative to the site root, and the
+``objects`` table records a generation for it, which stands in for the
+modification time of its XML file. Removing an object from the cache
+removes its entry from ``objects``, so that it's rebuilt when next used.
+
+Functions decorated with ``transaction`` run in a single transaction, which
+is rolled back if they raise an exception; nested calls join the outermost
+transaction.
+
+"""
+
+import os
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from hojarama import HojaramaError, site
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS objects (
+        path TEXT PRIMARY KEY,
+        generation REAL NOT NULL);
+
+    CREATE TABLE IF NOT EXISTS languages (
+        position INTEGER PRIMARY KEY,
+        lang_id TEXT NOT NULL UNIQUE,
+        name TEXT,
+        hidden INTEGER NOT NULL,
+        is_default INTEGER NOT NULL);
+
+    CREATE TABLE IF NOT EXISTS translations (
+        term TEXT NOT NULL,
+        lang_id TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (term, lang_id));
+
+    CREATE TABLE IF NOT EXISTS hidden (
+        lang_id TEXT NOT NULL,
+        node TEXT NOT NULL,
+        PRIMARY KEY (lang_id, node));
+
+    CREATE TABLE IF NOT EXISTS index_records (
+        lang_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        level INTEGER NOT NULL,
+        node TEXT NOT NULL,
+        parent INTEGER,
+        title TEXT,
+        PRIMARY KEY (lang_id, position));
+
+    CREATE UNIQUE INDEX IF NOT EXISTS index_nodes
+        ON index_records (lang_id, node);
+
+    CREATE INDEX IF NOT EXISTS index_parents
+        ON index_records (lang_id, parent);
+"""
+
+_LOCAL = threading.local()
+
+
+def _key(path):
+    """Return the key of the object stored for `path`."""
+    return os.path.relpath(path, site().root).replace(os.sep, "/")
+
+
+def active():
+    """Return True if persistent objects are stored in SQLite."""
+    backend = getattr(_LOCAL, "backend", None)
+    if backend is None:
+        from Config import snapshot
+        backend = snapshot().backend
+    return backend == "sqlite"
+
+
+def connection():
+    """Return this thread's connection to the current site's database."""
+    path = db_path()
+    connections = getattr(_LOCAL, "connections", None)
+    if connections is None:
+        connections = _LOCAL.connections = {}
+        _LOCAL.depth = 0
+    try:
+        return connections[path]
+    except KeyError:
+        if sqlite3 is None:
+            raise HojaramaError("cannot use the sqlite backend: "
+                                "the sqlite3 module is not available")
+        db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        db.executescript(SCHEMA)
+        connections[path] = db
+        return db
+
+
+def db_path():
+    """Return the path of the current site's database."""
+    return os.path.join(site().root, "site", "metadata.db")
+
+
+def forget(path):
+    """Remove the objects stored for `path` and below from the registry."""
+    key = _key(path)
+    connection().execute("DELETE FROM objects WHERE path = ? OR path LIKE ?",
+                         (key, key + "/%"))
+
+
+def generation(path):
+    """Return the generation of the object stored for `path`, or None."""
+    row = connection().execute("SELECT generation FROM objects WHERE path = ?",
+                               (_key(path),)).fetchone()
+    return None if row is None else row[0]
+
+
+def switch_backend():
+    """Move site data to the newly configured backend, and reset the cache."""
+    from hojarama import Persistent
+    from Languages import Languages
+    from Translations import Translations
+    if active():
+        connection().execute("DELETE FROM objects")
+    elif os.path.exists(db_path()):
+        for cls in Languages, Translations:
+            _LOCAL.backend = "sqlite"
+            try:
+                obj = cls()
+            finally:
+                _LOCAL.backend = None
+            obj.write()
+    Persistent.reset_cache()
+
+
+def transaction(func):
+    """Run `func` in a transaction, if objects are stored in SQLite."""
+    def wrapper(*args, **kwargs):
+        """Transaction wrapper function."""
+        if not active():
+            return func(*args, **kwargs)
+        db = connection()
+        if _LOCAL.depth == 0:
+            db.execute("BEGIN IMMEDIATE")
+        _LOCAL.depth += 1
+        try:
+            result = func(*args, **kwargs)
+        except:
+            _LOCAL.depth -= 1
+            if _LOCAL.depth == 0:
+                db.execute("ROLLBACK")
+            raise
+        else:
+            _LOCAL.depth -= 1
+            if _LOCAL.depth == 0:
+                db.execute("COMMIT")
+            return result
+    wrapper.__doc__ = func.__doc__
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+@transaction
+def save(obj, changes=()):
+    """Save `obj`, or just `changes` to it, and record a new generation."""
+    db = connection()
+    if changes:
+        for statement, parameters in changes:
+            if isinstance(parameters, list):
+                db.executemany(statement, parameters)
+            else:
+                db.execute(statement, parameters)
+    else:
+        obj._save(db)
+    key = _key(obj.path)
+    previous = generation(obj.path) or 0
+    db.execute("INSERT OR REPLACE INTO objects (path, generation) "
+               "VALUES (?, ?)", (key, max(time.time(), previous + 1e-6)))
@@ -21,12 +21,15 @@
 """Support for command-line tools."""
 
 import locale
+import shlex
 import textwrap
 import sys
 
 from optparse import OptionParser
 
-from hojarama import log, VERSION
+from hojarama import log, Persistent, VERSION
+
+from hrsqlite import transaction
 
 ENCODING = locale.getpreferredencoding()
 
@@ -46,10 +49,25 @@ def _log_action(command, opt, arg, help_str):
         log.debug("tools/%s %s %s # %s" % (command, opt, arg, help_str))
 
 
+def _batch(option, opt_str, arg, parser, command, obj, spec, meta, confirm):
+    """Run each line of the file `arg` [or stdin if "-"] as a command."""
+    _log_action(command, opt_str, arg, option.help)
+    try:
+        batch_file = sys.stdin if arg == "-" else open(arg)
+        lines = batch_file.readlines()
+    except IOError, exception:
+        parser.error("cannot read batch file %s: %s" % (arg, exception))
+    batch_parser = Parser(command, obj, spec, meta, confirm)
+    batch_parser.line = 0
+    transaction(_run_batch)(batch_parser, lines)
+
+
 def _callback(option, opt_str, arg, parser, command, obj, metavar, force):
     """Take an action based on the specified option."""
     _log_action(command, opt_str, arg, option.help)
-    if force and not parser.values.force:
+    if force and parser.line is not None and not parser.values.force:
+        parser.error("%s requires --force in a batch" % opt_str)
+    elif force and not parser.values.force:
         prompt = ("Deleting %s will IRREVERSIBLY DESTROY all of its data.\n"
                   "Are you sure you want to do this?\n"
                   "Type 'yes' [in full] to continue; anything else to abort: "
@@ -86,9 +104,22 @@ def _gpl(option, opt_str, arg, parser, command):
         parser.error(exception.message)
 
 
-def run_parser(command, obj, spec, meta, confirm=None):
+def _run_batch(parser, lines):
+    """Run each of `lines` with `parser`, deferring writes until the end."""
+    Persistent.begin_batch()
+    for number, line in enumerate(lines):
+        parser.line = number + 1
+        args = shlex.split(line, comments=True)
+        if args:
+            _, extra_args = parser.parse_args(args)
+            if extra_args:
+                parser.error("unexpected argument %s" % extra_args[0])
+    Persistent.end_batch()
+
+
+def run_parser(command, obj, spec, meta, confirm=None, batch=False):
     """Activate the parser."""
-    parser = Parser(command, obj, spec, meta, confirm)
+    parser = Parser(command, obj, spec, meta, confirm, batch)
     _, extra_args = parser.parse_args()
     if len(sys.argv) == 1 or extra_args:
         parser.print_help()
@@ -98,9 +129,10 @@ class Parser(OptionParser):
 
     """Option parser for command-line tools."""
 
-    def __init__(self, command, obj, spec, meta, confirm=None):
+    def __init__(self, command, obj, spec, meta, confirm=None, batch=False):
         OptionParser.__init__(self, version="%%prog version %s" % VERSION)
         self.usage = command
+        self.line = None
         self.obj = obj
         for opt, long_opt, var, help_str in spec:
             force = (opt == confirm)
@@ -122,6 +154,16 @@ class Parser(OptionParser):
                 kwargs["type"] = "string"
             self.add_option("-%s" % opt, "--%s" % long_opt, **kwargs)
             self.__update_usage(long_opt, var, force)
+        if batch:
+            self.add_option("-b", "--batch", action="callback",
+                            callback=_batch, type="string", metavar="FILE",
+                            callback_args=(command, obj, spec, meta, confirm),
+                            help="run the commands in FILE [one per line, "
+                                 "or '-' for standard input], writing "
+                                 "site data only at the end; other files, "
+                                 "such as copied pages and .htaccess, "
+                                 "change as each command runs")
+            self.__update_usage("batch", "FILE", False)
         self.add_option("-g", "--gpl", action="callback",
                         callback=_gpl, callback_args=(command,),
                         help="display copyright and licence information")
@@ -140,3 +182,8 @@ class Parser(OptionParser):
         else:
             self.usage += " [--%s=%s]" % (long_opt, var)
 
+    def error(self, msg):
+        """Exit with the error `msg`, identifying the line in a batch."""
+        if self.line is not None:
+            msg = "line %d: %s" % (self.line, msg)
+        OptionParser.error(self, msg)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# hr/hrxml.py
+# Copyright (c) 2007 Zero Piraeus <z@hojarama.org>
+#
+# This file is part of Hojarama [release 0.08.01].
+#
+# Hojarama is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# Hojarama is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Reusable, pre-configured XML parsers."""
+
+import threading
+
+from lxml import etree
+
+# Options for each kind of parser:
+#
+#   content - page content and templates, where whitespace is significant.
+#   meta    - documents read only for their structure and attributes.
+#   cache   - trusted files written by Hojarama itself, which may be large.
+#
+# None of them load DTDs or touch the network.
+PARSERS = {"content": {"load_dtd": False,
+                       "no_network": True,
+                       "resolve_entities": False},
+
+           "meta":    {"load_dtd": False,
+                       "no_network": True,
+                       "remove_blank_text": True,
+                       "remove_comments": True,
+                       "remove_pis": True,
+                       "resolve_entities": False},
+
+           "cache":   {"huge_tree": True,
+                       "load_dtd": False,
+                       "no_network": True,
+                       "remove_blank_text": True,
+                       "resolve_entities": False}}
+
+_LOCAL = threading.local()
+
+
+def parser(kind="content"):
+    """Return the current thread's parser for documents of type `kind`."""
+    parsers = _LOCAL.__dict__.setdefault("parsers", {})
+    try:
+        return parsers[kind]
+    except KeyError:
+        parsers[kind] = etree.XMLParser(**PARSERS[kind])
+        return parsers[kind]
+
+
+def parse(source, kind="content"):
+    """Parse the XML file `source` with a `kind` parser, and return it."""
+    return etree.parse(source, parser(kind))